@@ -0,0 +1,338 @@
+import os
+import shutil
+import hashlib
+import numpy as np
+from dataclasses import dataclass
+
+"""
+On-disk cache of per-track analysis results and pipeline stage outputs
+entries are keyed by a hash of the decoded PCM, so a track is analysed once
+however it was loaded; every result is kept as an .npy file and memory mapped
+when read back
+the caches are capped in size, the least recently used entries are evicted
+once everything below a cache's directory grows past its max_bytes
+"""
+
+# bump when an analysis changes so stale results are not reused
+ANALYSIS_VERSION = 1
+
+# default size cap of a cache directory
+DEFAULT_MAX_BYTES = 4 * 1024**3
+
+def default_cache_root():
+    """cache directory, SAMPLE_PI_ANALYSIS_CACHE or ~/.cache/sample_pi_analysis"""
+    return os.environ.get(
+        "SAMPLE_PI_ANALYSIS_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "sample_pi_analysis")
+    )
+
+def default_max_bytes():
+    """size cap of a cache, SAMPLE_PI_ANALYSIS_CACHE_MAX_MB or DEFAULT_MAX_BYTES"""
+    max_mb = os.environ.get("SAMPLE_PI_ANALYSIS_CACHE_MAX_MB")
+    return int(float(max_mb) * 1024**2) if max_mb else DEFAULT_MAX_BYTES
+
+def _entries(root):
+    """
+    every entry directory (one holding result files) below root
+
+    Returns:
+        list of (last used time, size in bytes, path)
+    """
+    entries = []
+    for path, _, files in os.walk(root):
+        if not any(f.endswith(".npy") for f in files):
+            continue
+        size = 0
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(path, f))
+            except OSError:
+                pass
+        try:
+            used = os.path.getmtime(path)
+        except OSError:
+            continue
+        entries.append((used, size, path))
+    return entries
+
+def _remove_entry(root, path):
+    """remove an entry directory and the parents it leaves empty below root"""
+    shutil.rmtree(path, ignore_errors=True)
+    parent = os.path.dirname(path)
+    while os.path.abspath(parent) != os.path.abspath(root):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+def prune(root, max_bytes, keep=None):
+    """
+    evict the least recently used entries below root until they fit in max_bytes
+
+    Args:
+        keep : optional entry directory never to evict, e.g. one just written
+    Returns:
+        bytes freed
+    """
+    entries = sorted(_entries(root))
+    total = sum(size for _, size, _ in entries)
+    freed = 0
+    for _, size, path in entries:
+        if total - freed <= max_bytes:
+            break
+        if keep is not None and os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        _remove_entry(root, path)
+        freed += size
+    return freed
+
+def clear(root):
+    """remove every entry below root"""
+    for _, _, path in _entries(root):
+        _remove_entry(root, path)
+
+def pcm_hash(pcm, frame_rate):
+    """
+    hash of decoded PCM and its format
+
+    Args:
+        pcm : integer PCM array of shape (frames, channels)
+        frame_rate : frames per second
+    Returns:
+        hex sha256 digest
+    """
+    pcm = np.ascontiguousarray(pcm)
+    h = hashlib.sha256(f"{ANALYSIS_VERSION}:{pcm.dtype.str}:{pcm.shape}:{frame_rate}:".encode())
+    h.update(memoryview(pcm).cast("B"))
+    return h.hexdigest()
+
+
+class TrackAnalysis:
+    """
+    analysis results of one track, one .npy file per named result
+
+    Attributes:
+        key : PCM hash of the track
+        path : directory holding the results
+    """
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+
+    def _file(self, name):
+        return os.path.join(self.path, f"{name}.npy")
+
+    def load(self, name):
+        """
+        memory mapped result, None if it is not cached
+        a hit marks the entry as used, so it is evicted last
+        """
+        try:
+            array = np.load(self._file(name), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(self.path)
+        except OSError:
+            pass
+        return array
+
+    def save(self, name, array):
+        """
+        write a result, returning it memory mapped from the cache
+        the file is written under a temporary name and renamed so readers
+        never see a partial result
+
+        Returns:
+            the cached array, or array itself if the cache cannot be written
+        """
+        array = np.asarray(array)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            part = f"{self._file(name)}.{os.getpid()}.part"
+            with open(part, "wb") as f:
+                np.save(f, array)
+            os.replace(part, self._file(name))
+        except OSError as e:
+            print(f"Could not cache {name}: {e}")
+            return array
+        cached = self.load(name)
+        return array if cached is None else cached
+
+    def get(self, name, compute):
+        """
+        cached result, computed with compute() and saved on a miss
+        """
+        array = self.load(name)
+        if array is None:
+            array = self.save(name, compute())
+        return array
+
+
+class AnalysisCache:
+    """
+    Directory of TrackAnalysis entries, one per distinct track
+
+    Attributes:
+        root : cache directory
+        max_bytes : size cap of everything below root, pipeline stages included
+                    when they are kept there (the default)
+    """
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root if root is not None else default_cache_root()
+        self.max_bytes = max_bytes if max_bytes is not None else default_max_bytes()
+
+    def entry(self, pcm, frame_rate):
+        """
+        TrackAnalysis for the given decoded PCM
+        the cache is pruned to max_bytes first, before the entry is in use
+        """
+        self.prune()
+        key = pcm_hash(pcm, frame_rate)
+        return TrackAnalysis(os.path.join(self.root, key[:2], key), key)
+
+    def prune(self, max_bytes=None):
+        """
+        evict least recently used entries until the cache fits in max_bytes
+        (self.max_bytes by default)
+
+        Returns:
+            bytes freed
+        """
+        return prune(self.root, self.max_bytes if max_bytes is None else max_bytes)
+
+    def clear(self):
+        """remove every cached entry"""
+        clear(self.root)
+
+
+def content_hash(*inputs):
+    """
+    hash of a sequence of inputs, arrays by dtype, shape and content,
+    anything else by its repr
+
+    Returns:
+        hex sha256 digest
+    """
+    h = hashlib.sha256(f"{ANALYSIS_VERSION}".encode())
+    for x in inputs:
+        if isinstance(x, np.ndarray):
+            x = np.ascontiguousarray(x)
+            h.update(f"|array:{x.dtype.str}:{x.shape}:".encode())
+            h.update(memoryview(x).cast("B"))
+        else:
+            h.update(f"|{x!r}".encode())
+    return h.hexdigest()
+
+def file_hash(path, chunk_size=1 << 20):
+    """hex sha256 digest of a file's content"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@dataclass
+class StageOutputs:
+    """
+    outputs of one pipeline stage
+
+    Attributes:
+        key : hash of the stage name and inputs, used as input to later stages
+        arrays : output name -> array
+        cached : whether the outputs were read back instead of computed
+    """
+    key: str
+    arrays: dict
+    cached: bool
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+
+class PipelineCache:
+    """
+    Persisted outputs of named pipeline stages
+    a stage is keyed by its name and a hash of its inputs; later stages take
+    the keys of the stages they build on as inputs, so changing one input
+    only reruns the stages downstream of it
+
+    Attributes:
+        root : cache directory
+        max_bytes : size cap of the cache, enforced after each stage is saved
+    """
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root if root is not None else os.path.join(default_cache_root(), "stages")
+        self.max_bytes = max_bytes if max_bytes is not None else default_max_bytes()
+
+    def run(self, stage, inputs, compute):
+        """
+        outputs of a stage, read back if a run with the same inputs finished before
+
+        Args:
+            stage : stage name
+            inputs : list of inputs (arrays, keys of earlier stages, parameters)
+            compute : function returning a dict of output name -> array
+        Returns:
+            StageOutputs
+        """
+        outputs = self.load(stage, inputs)
+        if outputs is not None:
+            return outputs
+        return self.save(stage, inputs, compute())
+
+    def _entry(self, stage, inputs):
+        key = content_hash(stage, *inputs)
+        return TrackAnalysis(os.path.join(self.root, stage, key), key)
+
+    def load(self, stage, inputs):
+        """
+        outputs of a finished run of a stage with these inputs
+
+        Returns:
+            StageOutputs, None if there is none
+        """
+        entry = self._entry(stage, inputs)
+        names = entry.load("_outputs")
+        if names is None:
+            return None
+        arrays = {str(name): entry.load(str(name)) for name in names}
+        if any(a is None for a in arrays.values()):
+            return None
+        return StageOutputs(entry.key, arrays, True)
+
+    def save(self, stage, inputs, arrays):
+        """
+        store the outputs of a stage, replacing any stored for the same inputs
+
+        Args:
+            arrays : dict of output name -> array
+        Returns:
+            StageOutputs
+        """
+        entry = self._entry(stage, inputs)
+        # cleared first and written last, marks the stage as complete
+        try:
+            os.remove(entry._file("_outputs"))
+        except OSError:
+            pass
+        arrays = {name: entry.save(name, a) for name, a in arrays.items()}
+        entry.save("_outputs", np.array(list(arrays), dtype=str))
+        prune(self.root, self.max_bytes, keep=entry.path)
+        return StageOutputs(entry.key, arrays, False)
+
+    def prune(self, max_bytes=None):
+        """
+        evict the least recently used stage outputs until the cache fits in
+        max_bytes (self.max_bytes by default)
+
+        Returns:
+            bytes freed
+        """
+        return prune(self.root, self.max_bytes if max_bytes is None else max_bytes)
+
+    def clear(self):
+        """remove every cached stage output"""
+        clear(self.root)
@@ -1,42 +1,332 @@
 import numpy as np
-from pymongo import MongoClient
 #from scipy.io.wavfile import read, write
 import os
-import gridfs
+import io
+import wave
+import hashlib
+import soundfile
+from storage_backend import DuplicateFileError, default_storage
+from dataclasses import dataclass
+from typing import Optional
 
 """
-simple GridFS MongoDB wrapper for storing and retrieving
-audio files and their metadata, specialised for extracted
-samples and Sonic Pi sample collections
+simple wrapper for storing and retrieving audio files and their
+metadata, specialised for extracted samples and Sonic Pi sample
+collections; files are kept in a storage backend (storage_backend),
+MongoDB GridFS by default
 """
 
+@dataclass
+class CatalogueEntry:
+    """
+    metadata of one stored file in a project, as listed by ProjectDatabase.get_catalogue
+
+    Attributes:
+        file_id : file ID
+        name : filename
+        has_metadata : whether the file was stored with a metadata document
+        rank : 0 for extracted samples, Sonic Pi rank otherwise
+        min_corr : minimum correlation threshold of a sample
+        n_bar_probs : length of the stored bar probabilities list
+        envelope : envelope in form ([x coordinates], [y coordinates])
+        kind : what the file is, see ProjectDatabase
+    """
+    file_id: object
+    name: str
+    has_metadata: bool = False
+    rank: Optional[int] = None
+    min_corr: Optional[float] = None
+    n_bar_probs: Optional[int] = None
+    envelope: Optional[tuple] = None
+    kind: Optional[str] = None
+
+# envelope points stored in sample metadata, in order
+ENVELOPE_POINTS = ["start", "attack", "decay", "sustain", "release"]
+
+# numpy types of the wav sample formats read_audio_array can view,
+# keyed by (format tag, bytes per sample), and the scale that maps them to [-1, 1)
+_WAV_DTYPES = {(1, 1): (np.uint8, 128), (1, 2): (np.int16, 2**15),
+               (1, 4): (np.int32, 2**31), (3, 4): (np.float32, 1)}
+
+def parse_wav(buf):
+    """
+    find the audio data in an in-memory wav file
+
+    Args:
+        buf: bytes-like wav file contents
+    Returns:
+        data : NumPy view into buf of shape (frames, channels)
+        frame_rate : sample rate in Hz
+    Raises:
+        ValueError: if buf is not a wav file of a format in _WAV_DTYPES
+    """
+    mv = memoryview(buf)
+    if len(mv) < 12 or bytes(mv[0:4]) != b"RIFF" or bytes(mv[8:12]) != b"WAVE":
+        raise ValueError("not a wav file")
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(mv):
+        chunk_id = bytes(mv[pos:pos + 4])
+        size = int.from_bytes(mv[pos + 4:pos + 8], "little")
+        body = pos + 8
+        if chunk_id == b"fmt ":
+            tag = int.from_bytes(mv[body:body + 2], "little")
+            channels = int.from_bytes(mv[body + 2:body + 4], "little")
+            frame_rate = int.from_bytes(mv[body + 4:body + 8], "little")
+            bits = int.from_bytes(mv[body + 14:body + 16], "little")
+            if tag == 0xFFFE and size >= 26:
+                # WAVE_FORMAT_EXTENSIBLE, the real tag starts the subformat GUID
+                tag = int.from_bytes(mv[body + 24:body + 26], "little")
+            fmt = (tag, channels, frame_rate, bits // 8)
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise ValueError("wav data before fmt chunk")
+            tag, channels, frame_rate, width = fmt
+            if (tag, width) not in _WAV_DTYPES:
+                raise ValueError(f"unsupported wav format {tag} with {width} byte samples")
+            dtype, _ = _WAV_DTYPES[(tag, width)]
+            # streamed writers may leave the size unset, the data then runs to the end
+            size = min(size, len(mv) - body)
+            frames = size // (width * channels)
+            data = np.frombuffer(buf, dtype=np.dtype(dtype).newbyteorder("<"), count=frames * channels, offset=body)
+            return data.reshape(frames, channels), frame_rate
+        # chunks are padded to an even length
+        pos = body + size + (size & 1)
+    raise ValueError("wav file has no data chunk")
+
+def wav_bytes(data, frame_rate):
+    """
+    in-memory wav file of integer PCM of shape (frames, channels)
+    """
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as out:
+        out.setnchannels(data.shape[1])
+        out.setsampwidth(data.dtype.itemsize)
+        out.setframerate(frame_rate)
+        out.writeframes(data.tobytes())
+    return buf.getvalue()
+
+def encode_payload(data, codec):
+    """
+    losslessly compress a wav payload with a soundfile format (e.g. "flac")
+
+    Args:
+        data:   bytes of a wav file
+        codec:  soundfile format name
+    Returns:
+        encoded bytes, or None if the payload is not 16-bit PCM the codec can hold exactly
+    """
+    try:
+        pcm, frame_rate = parse_wav(data)
+    except ValueError:
+        return None
+    if pcm.dtype != np.int16:
+        return None
+    buf = io.BytesIO()
+    soundfile.write(buf, pcm, frame_rate, format=codec.upper(), subtype="PCM_16")
+    return buf.getvalue()
+
+def decode_payload(data):
+    """
+    decode a payload written by encode_payload
+
+    Returns:
+        (int16 data of shape (frames, channels), frame_rate)
+    """
+    return soundfile.read(io.BytesIO(data), dtype="int16", always_2d=True)
+
+class BlobStore:
+    """
+    Content-addressed store of audio payloads shared by every database
+
+    each payload is stored once, under the hash of its PCM data, and counts
+    how many files refer to it so it can be removed when the last one goes
+
+    Attributes:
+        backend (StorageBackend):   store holding one file per hash
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        try:
+            self.backend.ensure_indexes(unique_filenames=True)
+        except Exception as e:
+            print("Failed to create blob store index:", e)
+
+    @staticmethod
+    def content_hash(data):
+        """
+        sha256 of the sample format and PCM data of a wav payload,
+        so files that differ only in their headers share one blob
+        (payloads that are not wav files NumPy can view are hashed whole)
+
+        Args:
+            data:   bytes of the payload
+        Returns:
+            hex digest
+        """
+        h = hashlib.sha256()
+        try:
+            pcm, frame_rate = parse_wav(data)
+            h.update(f"{pcm.dtype.str}:{pcm.shape[1]}:{frame_rate}:".encode())
+            h.update(pcm.tobytes())
+        except ValueError:
+            h.update(data)
+        return h.hexdigest()
+
+    def put(self, data):
+        """
+        Store a payload unless an identical one is already stored,
+        either way adding one reference to it
+
+        Args:
+            data:   bytes of the payload
+        Returns:
+            hash the payload is stored under
+        """
+        key = self.content_hash(data)
+        if self.backend.inc_metadata(key, "refs", 1):
+            return key
+        try:
+            self.backend.put(data, key, {"kind": "blob", "refs": 1})
+        except DuplicateFileError:
+            # stored by someone else since the lookup
+            self.backend.inc_metadata(key, "refs", 1)
+        return key
+
+    def buffer(self, key):
+        """
+        Returns:
+            bytes-like object holding the payload stored under key
+        """
+        return self.backend.buffer(self.backend.find_one(key)['_id'])
+
+    def release(self, key):
+        """
+        Drop one reference to a payload, deleting it when none are left
+        """
+        result = self.backend.inc_metadata(key, "refs", -1)
+        if result and result['metadata']['refs'] <= 0:
+            self.backend.delete(result['_id'])
+
+
 class Database:
     """
-    Base wrapper around MongoDB GridFS bucket for binary files
+    Base wrapper around a storage backend for binary files
     
     Attributes:
-        db  (Database): The PyMongo database instance
-        bucket  (GridFS):   The GridFS bucket for file storag
+        storage (Storage):  where the database and the shared blob store live
+        backend (StorageBackend):   the files of this database
+        blobs   (BlobStore):    shared store for payloads of the kinds in blob_kinds
     """
-    def __init__(self, name):
+    # whether each filename that has a metadata.kind may only be stored once
+    unique_filenames = False
+    # kinds of file whose audio is kept once in the shared BlobStore,
+    # the file in this database then only refers to it by hash
+    blob_kinds = ("sonic_sample",)
+    # kinds of file whose audio is compressed with codec when stored
+    compress_kinds = ()
+
+    def __init__(self, name, codec=None, storage=None):
+        """
+        Open or create database called 'name
+
+        Args:
+            codec:  soundfile format (e.g. "flac") to store compress_kinds files in,
+                    None stores them as wav
+            storage:    Storage to keep the database in, default_storage() if None
+        """
+        self.storage = storage if storage is not None else default_storage()
+        self.codec = codec
+        self.backend = self.storage.open(name)
+        self.blobs = BlobStore(self.storage.open("AudioBlobs"))
+        self._ensure_indexes()
+
+    def _ensure_indexes(self):
         """
-        Connect to localhost and open or create database called 'name
+        Create the indexes lookups rely on if they do not exist yet
         """
-        self.cluster = MongoClient("localhost", 27017)
-        #database
-        self.db = self.cluster[name]
-        self.bucket = gridfs.GridFS(self.db)
+        try:
+            self.backend.ensure_indexes(self.unique_filenames)
+        except Exception as e:
+            print("Failed to create database indexes:", e)
     
-    def add_one_audio_file(self, url, name):
+    def _put(self, data, name, metadata=None):
+        """
+        Store a payload under name, in the shared BlobStore if its kind is in blob_kinds
+
+        Args:
+            data:   bytes or file object of the payload
+            name:   Filename to assign
+            metadata:   metadata document for the file
+        Returns:
+            file ID
+        """
+        if self.codec is not None and metadata is not None and metadata.get("kind") in self.compress_kinds:
+            if not isinstance(data, (bytes, bytearray)):
+                data = data.read()
+            encoded = encode_payload(data, self.codec)
+            if encoded is not None:
+                # the codec used is recorded so readers know to decode it
+                metadata = dict(metadata, codec=self.codec, wav_length=len(data))
+                data = encoded
+        if metadata is not None and metadata.get("kind") in self.blob_kinds:
+            if not isinstance(data, (bytes, bytearray)):
+                data = data.read()
+            key = self.blobs.put(data)
+            metadata = dict(metadata, blob=key, blob_length=len(data))
+            return self.backend.put(b"", name, metadata)
+        return self.backend.put(data, name, metadata)
+
+    def _buffer(self, doc):
+        """
+        Returns:
+            bytes-like object with the stored payload of document doc
+        """
+        key = (doc.get('metadata') or {}).get('blob')
+        if key is not None:
+            return self.blobs.buffer(key)
+        return self.backend.buffer(doc['_id'])
+
+    def _read(self, doc):
+        """
+        Returns:
+            contents of the file of document doc as wav bytes, decoded if it was compressed
         """
-        Store the file at 'url' in GridFS under key 'name'
+        data = self._buffer(doc)
+        if (doc.get('metadata') or {}).get('codec') is not None:
+            return wav_bytes(*decode_payload(data))
+        return bytes(data)
+
+    def _delete(self, doc):
+        """
+        Delete the file of document doc, releasing its blob if it has one
+        """
+        self.backend.delete(doc['_id'])
+        key = (doc.get('metadata') or {}).get('blob')
+        if key is not None:
+            self.blobs.release(key)
+
+    @staticmethod
+    def payload_length(doc):
+        """
+        Returns:
+            size in bytes of the audio of document doc as a wav file
+        """
+        metadata = doc.get('metadata') or {}
+        return metadata.get('wav_length', metadata.get('blob_length', doc.get('length')))
+
+    def add_one_audio_file(self, url, name, kind=None):
+        """
+        Store the file at 'url' under key 'name'
 
         Args:
             url:    Path on local filesystem
-            name:   Filename to assign in GridFS
+            name:   Filename to assign
+            kind:   optional kind to store in the file's metadata
         """
+        metadata = {"kind": kind} if kind is not None else None
         with open(url, "rb") as file_data:
-            file_id = self.bucket.put(file_data, filename=name)
+            file_id = self._put(file_data, name, metadata)
     
     def read_one_audio_file_name(self, name, dest, temp=False):
         """
@@ -47,13 +337,13 @@ class Database:
             dest:   Path to store file contents to
             temp:   Bool indicating if file is temporary
         """
-        results = self.bucket._files.find_one({'filename': name})
+        results = self.backend.find_one(name)
         if results:
             if temp:
-                dest.write(self.bucket.get(results['_id']).read())
+                dest.write(self._read(results))
             else:
                 with open(dest, 'wb') as output_file:
-                    output_file.write(self.bucket.get(results['_id']).read())
+                    output_file.write(self._read(results))
         else:
             print("file not found", name)
 
@@ -66,24 +356,55 @@ class Database:
             dest:   Path to store file contents to
             temp:   Bool indicating if file is temporary
         """
-        results = self.bucket._files.find_one({'_id': id})
+        results = self.backend.find_one(file_id=id)
         if results:
             if temp:
-                dest.write(self.bucket.get(results['_id']).read())
+                dest.write(self._read(results))
             else:
                 with open(dest, 'wb') as output_file:
-                    output_file.write(self.bucket.get(results['_id']).read())
+                    output_file.write(self._read(results))
         else:
             print("file not found", id)
     
+    def read_audio_array(self, name=None, dtype=None, file_id=None):
+        """
+        Read a stored wav file straight into memory and view its samples,
+        the payload is copied at most once, into a preallocated buffer
+        (compressed files are decoded from it instead)
+
+        Args:
+            name:   Name of file in database
+            dtype:  None for the stored sample type, or np.float32 for samples in [-1, 1)
+            file_id:    File ID to read instead of looking up name
+        Returns:
+            (data of shape (frames, channels), frame_rate) or None if the file is not found
+        Raises:
+            ValueError: if the file is not a wav file NumPy can view
+        """
+        result = self.backend.find_one(name, file_id)
+        if not result:
+            print("file not found", name if file_id is None else file_id)
+            return None
+        buf = self._buffer(result)
+
+        if (result.get('metadata') or {}).get('codec') is not None:
+            data, frame_rate = decode_payload(buf)
+        else:
+            data, frame_rate = parse_wav(buf)
+        if dtype is not None and np.dtype(dtype) != data.dtype:
+            _, scale = [v for v in _WAV_DTYPES.values() if v[0] == data.dtype.type][0]
+            offset = scale if data.dtype == np.uint8 else 0
+            data = ((data.astype(dtype) - offset) / scale).astype(dtype)
+        return data, frame_rate
+
     def file_exists(self, name):
         """
-        Check if 'name' is in GridFS
+        Check if 'name' is stored
 
         Returns:
             file ID or False
         """
-        result = self.bucket._files.find_one({'filename': name})
+        result = self.backend.find_one(name)
         if result:
             return result['_id']
         return False
@@ -94,36 +415,133 @@ class SonicPiSampleDatabase(Database):
 
     Inherits from Database and uses local 'sample-pi-main' folder for bulk upload
     """
-    def __init__(self):
-        super().__init__("SonicPiSamples")
+    def __init__(self, storage=None):
+        super().__init__("SonicPiSamples", storage=storage)
         self.folder = "C:/Users/uno4e/OneDrive/Documents/Cambridge II/project/sample-pi-main"
     
     def add_sonic_samples(self):
         """
-        Upload any wav files not already in GridFS
+        Upload any wav files not already stored
         """
         for i, name in enumerate(os.listdir(self.folder)):
             path = os.path.join(self.folder, name)
             if os.path.isfile(path):
-                self.add_one_audio_file(path, name)
+                self.add_one_audio_file(path, name, kind="sonic_sample")
     
     def get_sonic_names(self):
         """
         Returns:
-            names:  all sample names stored to GridFS
+            names:  all sample names stored
         """
-        names = []
-        for f in self.bucket._files:
-            names.append(f['filename'])
-        return names
+        return [f['filename'] for f in self.backend.find()]
 
 
 class ProjectDatabase(Database):
     """
     Stores and retrieves files for a single project
+
+    every file records what it is in metadata.kind:
+        full_track, extracted_sample, sonic_sample, repeated, separated_loop
+    and there is one file per name of each kind
+
+    full tracks, repeated tracks and separated loops are stored in codec
+    (flac by default) and recorded as such in metadata.codec, files stored
+    without one are read as wav
+
+    metadata of every file can be listed with one query into an in-memory
+    catalogue (get_catalogue), which later lookups and writes keep up to date
     """
-    def __init__(self, name):
-        super().__init__(name)
+    unique_filenames = True
+    # long, often mostly silent tracks, stored losslessly compressed
+    compress_kinds = ("full_track", "repeated", "separated_loop")
+
+    def __init__(self, name, codec="flac", storage=None):
+        self._catalogue = None
+        super().__init__(name, codec, storage)
+
+    def _ensure_indexes(self):
+        """
+        Record kinds for files stored before they were, then create indexes
+        """
+        try:
+            self.backend.record_legacy_kinds()
+        except Exception as e:
+            print("Failed to record kinds of stored files:", e)
+        super()._ensure_indexes()
+
+    @staticmethod
+    def _entry_from_document(doc):
+        """
+        build a CatalogueEntry from a files document
+        (n_bar_probs is given by the listing query instead of the full list)
+        """
+        metadata = doc.get('metadata')
+        if metadata is None:
+            return CatalogueEntry(doc['_id'], doc['filename'])
+        envelope = None
+        if all(p in metadata for p in ENVELOPE_POINTS):
+            points = [metadata[p] for p in ENVELOPE_POINTS]
+            envelope = ([p[0] for p in points], [p[1] for p in points])
+        n_bar_probs = doc.get('n_bar_probs')
+        if n_bar_probs is None and isinstance(metadata.get('bar_probs'), list):
+            n_bar_probs = len(metadata['bar_probs'])
+        return CatalogueEntry(doc['_id'], doc['filename'], True, metadata.get('rank'),
+                              metadata.get('min_corr'), n_bar_probs, envelope, metadata.get('kind'))
+
+    def get_catalogue(self, refresh=False):
+        """
+        Metadata of every file in the project from a single query
+        bar probabilities are only counted, not transferred
+
+        Args:
+            refresh: re-run the query even if a catalogue is already loaded
+        Returns:
+            dict of filename -> CatalogueEntry
+        """
+        if self._catalogue is None or refresh:
+            catalogue = {}
+            for doc in self.backend.catalogue():
+                # keep the first file of a name, as find_one would
+                if doc['filename'] not in catalogue:
+                    catalogue[doc['filename']] = self._entry_from_document(doc)
+            self._catalogue = catalogue
+        return self._catalogue
+
+    def _catalogue_put(self, file_id, name, metadata=None):
+        """record a newly stored file in the catalogue if one is loaded"""
+        if self._catalogue is not None and file_id is not None:
+            self._catalogue[name] = self._entry_from_document({'_id': file_id, 'filename': name, 'metadata': metadata})
+
+    def _catalogue_remove(self, name):
+        """forget a deleted file if a catalogue is loaded"""
+        if self._catalogue is not None:
+            self._catalogue.pop(name, None)
+
+    def _lookup(self, name):
+        """
+        catalogue entry for name if a catalogue is loaded
+
+        Returns:
+            CatalogueEntry, None if the file is not stored,
+            or False if there is no catalogue to answer from
+        """
+        if self._catalogue is None:
+            return False
+        return self._catalogue.get(name)
+
+    def file_exists(self, name):
+        """
+        Check if 'name' is stored, from the catalogue when one is loaded
+
+        Returns:
+            file ID or False
+        """
+        entry = self._lookup(name)
+        if entry is False:
+            return super().file_exists(name)
+        if entry is None:
+            return False
+        return entry.file_id
     
     def add_full_track_file(self, path, downbeats):
         """
@@ -140,19 +558,21 @@ class ProjectDatabase(Database):
 
         # each project can only have one full_track
         # if one is already stored delete it
-        result = self.bucket._files.find_one({'filename': 'full_track'})
+        result = self.backend.find_one('full_track')
         if result:
-            self.bucket.delete(result['_id'])
+            self._delete(result)
+            self._catalogue_remove('full_track')
         
         try:
             with open(path, "rb") as file_data:
-                file_id = self.bucket.put(file_data, filename='full_track', metadata={"downbeats": downbeats})
+                file_id = self._put(file_data, 'full_track', {"kind": "full_track", "downbeats": downbeats})
         except Exception as e:
             print("Failed to save original track to database:", e)
             return None
+        self._catalogue_put(file_id, 'full_track', {"kind": "full_track", "downbeats": downbeats})
         return file_id
     
-    def add_one_sample_file_with_env_list(self, name, path, env, min_corr, bar_probs, rank):
+    def add_one_sample_file_with_env_list(self, name, path, env, min_corr, bar_probs, rank, kind=None):
         """
         env: coordinates for samples envelope in form [[xs], [ys]]
         """
@@ -161,9 +581,9 @@ class ProjectDatabase(Database):
         decay = (env[0][2], env[1][2])
         sustain = (env[0][3], env[1][3])
         release = (env[0][4], env[1][4])
-        return self.add_one_sample_file(name, path, start, attack, decay, sustain, release, min_corr, bar_probs, rank)
+        return self.add_one_sample_file(name, path, start, attack, decay, sustain, release, min_corr, bar_probs, rank, kind=kind)
     
-    def add_one_sample_file(self, name, path, start, attack, decay, sustain, release, min_corr, bar_probs, rank, buf=False):
+    def add_one_sample_file(self, name, path, start, attack, decay, sustain, release, min_corr, bar_probs, rank, buf=False, kind=None):
         """
         Read local file and store it as a sample
         Stores envelope, min correlation, downbeat probababilities, rank as metadata
@@ -175,21 +595,25 @@ class ProjectDatabase(Database):
             bar_probs:  probability of sample occurring at each downbeat
             rank:   for Sonic Pi samples provide rank of how similar sample is to track
             buf:    boolean indicating if the path is actually raw audio data in a buffer
+            kind:   extracted_sample or sonic_sample, by default decided by rank
 
         Returns:
             fileID or None if upload failed or sample of same name already stored
         """
         
-        result = self.bucket._files.find_one({'filename': name})
-        if result:
+        if self.file_exists(name):
             return None
         else:
+            if kind is None:
+                kind = "extracted_sample" if rank == 0 else "sonic_sample"
+            metadata = {"kind": kind, "start": start, "attack": attack, "decay": decay, "sustain": sustain, "release": release, "min_corr": min_corr, "bar_probs": bar_probs, "rank":rank}
             try:
                 if buf:
-                    file_id = self.bucket.put(path.read(), filename=name, metadata={"start": start, "attack": attack, "decay": decay, "sustain": sustain, "release": release, "min_corr": min_corr, "bar_probs": bar_probs, "rank":rank})
+                    file_id = self._put(path.read(), name, metadata)
                 else:
                     with open(path, "rb") as file_data:
-                        file_id = self.bucket.put(file_data, filename=name, metadata={"start": start, "attack": attack, "decay": decay, "sustain": sustain, "release": release, "min_corr": min_corr, "bar_probs": bar_probs, "rank":rank})
+                        file_id = self._put(file_data, name, metadata)
+                self._catalogue_put(file_id, name, metadata)
                 return file_id
             except Exception as e:
                 print("Failed to store sample file:", e)
@@ -206,15 +630,17 @@ class ProjectDatabase(Database):
         Returns:
             fileID or None if upload failed
         """
-        result = self.bucket._files.find_one({'filename': name})
+        result = self.backend.find_one(name)
         if result:
-            self.bucket.delete(result['_id'])
+            self._delete(result)
+            self._catalogue_remove(name)
         try:
             with open(path, "rb") as file_data:
-                file_id = self.bucket.put(file_data, filename=name)
+                file_id = self._put(file_data, name, {"kind": "repeated"})
         except Exception as e:
             print("Failed to store repeated sample file to database:", e)
             return None
+        self._catalogue_put(file_id, name, {"kind": "repeated"})
         return file_id
 
     def add_source_separated_loop(self, name, buf):
@@ -229,14 +655,16 @@ class ProjectDatabase(Database):
         Returns:
             fileID or None if upload failed or sample of same name already stored
         """
-        result = self.bucket._files.find_one({'filename': name})
+        result = self.backend.find_one(name)
         if result:
-            self.bucket.delete(result['_id'])
+            self._delete(result)
+            self._catalogue_remove(name)
         try:
-            file_id = self.bucket.put(buf.read(), filename=name)
+            file_id = self._put(buf.read(), name, {"kind": "separated_loop"})
         except Exception as e:
             print("Failed to store repeated sample file to database:", e)
             return None
+        self._catalogue_put(file_id, name, {"kind": "separated_loop"})
         return file_id
 
     def get_envelope(self, name):
@@ -244,13 +672,16 @@ class ProjectDatabase(Database):
         Get the envelope of sample file 'name'
 
         Args:
-            name: GridFS filename to look up
+            name: filename to look up
         
         Returns:
             envelope in form [x coordinates, y coordinates]
             None if no file found
         """
-        result = self.bucket._files.find_one({'filename': name})
+        entry = self._lookup(name)
+        if entry is not False:
+            return entry.envelope if entry is not None else None
+        result = self.backend.find_one(name)
         if result:
             start = result['metadata']["start"]
             attack = result['metadata']["attack"]
@@ -266,13 +697,16 @@ class ProjectDatabase(Database):
         Get the min correlation of sample file 'name'
 
         Args:
-            name: GridFS filename to look up
+            name: filename to look up
         
         Returns:
             min correlation
             None if no file found
         """
-        result = self.bucket._files.find_one({'filename': name})
+        entry = self._lookup(name)
+        if entry is not False:
+            return entry.min_corr if entry is not None else None
+        result = self.backend.find_one(name)
         if result:
             return result['metadata']["min_corr"]
         return None
@@ -282,13 +716,13 @@ class ProjectDatabase(Database):
         Get the occurence probabilities of sample file 'name'
 
         Args:
-            name: GridFS filename to look up
+            name: filename to look up
         
         Returns:
             probabilities
             None if no file found
         """
-        result = self.bucket._files.find_one({'filename': name})
+        result = self.backend.find_one(name)
         if result:
             return result['metadata']["bar_probs"]
         return None
@@ -301,23 +735,63 @@ class ProjectDatabase(Database):
             list of downbeats
             empty list if no file found
         """
-        result = self.bucket._files.find_one({'filename':'full_track'})
+        result = self.backend.find_one('full_track')
         #print(result)
         if result:
             return result['metadata']['downbeats']
         return []
 
-    def update_sample_data(self, sample):
+    def update_metadata(self, name, fields):
+        """
+        Set metadata fields of a stored file in place, the audio chunks are left alone
+
+        Args:
+            name:   stored filename
+            fields: dict of metadata field -> new value
+        Returns:
+            True if a file was updated, False if no file is called name
+        Raises:
+            whatever the backend raises if the update fails, so a failed update
+            is never mistaken for a missing file
+        """
+        result = self.backend.set_metadata(name, fields)
+        if result is None:
+            return False
+        self._catalogue_put(result['_id'], name, result.get('metadata'))
+        return True
+
+    def update_sample_data(self, sample, audio_changed=False):
         """
-        Replace sample file with updated information
+        Store updated information of a sample
+        only envelope, min_corr and bar_probs are rewritten in place unless the
+        audio changed, in which case the file is replaced
 
         Args:
             sample: instance of SampleFile class (from audiofile_manager)
+            audio_changed:  whether the sample's audio differs from the stored file
         """
-        result = self.bucket._files.find_one({'filename': sample.name})
+        name = sample.database_name
+        env = sample.get_envelope()
+        fields = {p: (env[0][i], env[1][i]) for i, p in enumerate(ENVELOPE_POINTS)}
+        fields["min_corr"] = sample.min_corr
+        fields["bar_probs"] = list(sample.downbeat_probs)
+
+        if not audio_changed:
+            try:
+                if self.update_metadata(name, fields):
+                    return
+            except Exception as e:
+                # the stored file is kept as it was rather than replaced
+                print("Failed to update sample metadata:", e)
+                return
+        # audio changed, or the sample is not stored yet
+        rank = 0
+        result = self.backend.find_one(name)
         if result:
-            self.bucket.delete(result['_id'])
-        new = self.add_one_sample_file_with_env_list(sample.name, sample.file_path, sample.get_envelope(), sample.min_corr, list(sample.downbeat_probs), 0)
+            rank = (result.get('metadata') or {}).get('rank', 0)
+            self._delete(result)
+            self._catalogue_remove(name)
+        new = self.add_one_sample_file_with_env_list(name, sample.file_path, env, sample.min_corr, fields["bar_probs"], rank, kind=sample.kind)
     
     def get_separated_loop_tracks(self, dest):
         """
@@ -328,13 +802,24 @@ class ProjectDatabase(Database):
         Returns:
             list of file paths
         """
-        result = self.bucket._files.find({"filename": "separated_loop.wav"})
+        result = self.backend.find(name="separated_loop.wav")
         files = []
         for i, r in enumerate(result):
             self.read_one_audio_file_id(r['_id'], f"{dest}/separated_track{i}.wav")
             files.append(f"{dest}/separated_track{i}.wav")
         return files
 
+    def _names_of_kind(self, kind, sort):
+        """
+        names of all files of a kind, from one query the backend answers
+        with its (kind, rank) index
+
+        Args:
+            kind:   metadata.kind to match
+            sort:   "filename" or "rank"
+        """
+        return [f['filename'] for f in self.backend.find(kind=kind, sort=sort)]
+
     def get_sample_names(self):
         """
         Get list of extracted samples saved in project database
@@ -342,21 +827,7 @@ class ProjectDatabase(Database):
         Returns:
             list of sample names
         """
-        samples = []
-        names = self.bucket.list()
-        for n in names:
-            result = self.bucket._files.find_one({"filename": n})
-            if result:
-                if result.get('metadata') != None:
-                    #print(result['metadata'])
-                    #rank = result['metadata'].get('rank')
-                    occurrence_probs = result['metadata'].get('bar_probs')
-                    # if it is a sample file it will have a rank in its metadata
-                    # if it is an extracted sample occurrence probailities will be a 1D list
-                    if occurrence_probs != None:
-                        if len(occurrence_probs) > 2:
-                            samples.append(n)
-        return samples
+        return self._names_of_kind("extracted_sample", "filename")
     
     def get_sonic_sample_names(self):
         """
@@ -365,18 +836,7 @@ class ProjectDatabase(Database):
         Returns:
             list of sample names
         """
-        samples = []
-        names = self.bucket.list()
-        for n in names:
-            result = self.bucket._files.find_one({"filename": n})
-            if result:
-                if result.get('metadata') != None:
-                    rank = result['metadata'].get('rank')
-                    # if it is a sample file it will have a rank in its metadata
-                    # if it is a sonic pi sample the rank will be greater than 0
-                    if rank != None and rank != 0:
-                        samples.append(n)
-        return samples
+        return self._names_of_kind("sonic_sample", "filename")
     
     def get_order_sonic_pi_samples(self):
         """
@@ -385,20 +845,8 @@ class ProjectDatabase(Database):
         Returns:
             list of sonic pi samples ordered by rank
         """
-        sample_names = self.get_sonic_sample_names()
-        samples = []
-        ranks = []
-        for s in sample_names:
-            result = self.bucket._files.find_one({"filename": s.upper()})
-            if result:
-                ranks.append(int(result['metadata']['rank']))
-                samples.append(s.lower())
-        ranks = np.array(ranks, dtype=np.int32)
-        samples = np.array(samples)
-        #print(ranks)
-        order = np.argsort(ranks)
-        samples = samples[order]
-        return samples
+        samples = self._names_of_kind("sonic_sample", "rank")
+        return np.array([s.lower() for s in samples])
 
 #database = SonicPiSampleDatabase()
 #database.read_one_audio_file("audio.wav")
@@ -7,6 +7,31 @@ or a reduced "envelope" view of an audio signal, depending on the current
 zoom level. This method is inspired from matplotlib's displaywaveform.
 """
 
+def minmax_pyramid(signal, base=16, min_points=512):
+    """
+    min/max display pyramid of a 1D signal
+    each level holds the minimum and maximum of every block of samples,
+    the block doubling from one level to the next
+
+    Args:
+        signal : 1D array
+        base : block length of the finest level
+        min_points : coarsest level kept has at least this many blocks
+    Returns:
+        list of (block, array of shape (2, n_blocks)) from finest to coarsest
+    """
+    n = len(signal)//base
+    x = np.asarray(signal[:n*base]).reshape(n, base)
+    level = np.stack([x.min(axis=1), x.max(axis=1)]) if n else np.zeros((2, 0), dtype=x.dtype)
+    block = base
+    levels = [(block, level)]
+    while level.shape[1]//2 >= min_points:
+        n = level.shape[1]//2
+        level = np.stack([level[0, :2*n].reshape(n, 2).min(axis=1), level[1, :2*n].reshape(n, 2).max(axis=1)])
+        block *= 2
+        levels.append((block, level))
+    return levels
+
 class Audio_Graph():
     """
     Dynamic audio waveform plotter with automatic downsampling
@@ -22,6 +47,7 @@ class Audio_Graph():
         bottom_env_line : PlotDataItem for negative envelope
         y           : latest audio signal
         times       : time axis values corresponding to y
+        pyramid     : optional min/max pyramid of y (see minmax_pyramid)
     """
     def __init__(self, graph, top_env, bottom_env):
         """
@@ -40,8 +66,9 @@ class Audio_Graph():
         self.bottom_env_line = bottom_env
         self.y = [] # buffer for most recent audio signal
         self.times = [] # corresponding time axis
+        self.pyramid = None
     
-    def getData(self, y, sr=22050):
+    def getData(self, y, sr=22050, pyramid=None):
         """
         Use new audio signal to update the display.
         Compute the time axis, choose step vs envelope mode
@@ -50,7 +77,9 @@ class Audio_Graph():
         Args:
             y   : 1D (or 2D) Numpy array of audio signal
             sr  : sample rate used to compute timestamps
+            pyramid : precomputed min/max pyramid of y, used for the envelope
         """
+        self.pyramid = pyramid
 
         if len(y) == 0:
             # clear both envelopes if there's no data
@@ -78,15 +107,21 @@ class Audio_Graph():
         # hop ensures envelope has at most max_points values
         max_points = 11025
         hop = max(1, y.shape[-1]//max_points)
-        x_frame = np.abs(librosa.util.frame(y, frame_length=hop, hop_length=hop))
-        y_env = x_frame.max(axis=1)
+        if self.pyramid:
+            # finest level whose blocks are at least hop long
+            block, level = next(((b, l) for b, l in self.pyramid if b >= hop), self.pyramid[-1])
+            y_bottom, y_top = level[0], level[1]
+            envelope = [self.times[: level.shape[1]*block : block], y_bottom, y_top]
+        else:
+            x_frame = np.abs(librosa.util.frame(y, frame_length=hop, hop_length=hop))
+            y_env = x_frame.max(axis=1)
 
-        #split envelope into top and bottom
-        y_bottom, y_top = -y_env[-1], y_env[0]
+            #split envelope into top and bottom
+            y_bottom, y_top = -y_env[-1], y_env[0]
+            envelope = [self.times[: len(y_top)* hop : hop], y_bottom, y_top]
 
         #only plot up to max_points worth of data here
         xdata, ydata = self.times[:max_points], y[0, :max_points]
-        envelope = [self.times[: len(y_top)* hop : hop], y_bottom, y_top]
         steps = [xdata, ydata[1:]]
 
         samples = y[0]
@@ -5,13 +5,19 @@ import wave
 from pydub import AudioSegment
 import os
 import tempfile
+import atexit
+import shutil
 from PyQt5.QtMultimedia import QMediaContent
 from PyQt5.QtCore import QUrl
 from pydub.playback import play
+from pydub.utils import ratio_to_db
 import librosa
 from envelope_processor import EnvelopePoint, Envelope, EnvelopeProcessor
 from repeat_processor import Repeater
-from correlator import Correlator
+from correlator import Correlator, TrackSpectrum, PeakIndex
+from audio_database import parse_wav
+from analysis_cache import AnalysisCache
+from audio_graph import minmax_pyramid
 
 """
 Defines core audio-file operations and interactions with the UI
@@ -24,38 +30,154 @@ done using EnvelopeProcessor, Repeater and Correlator, respectively
 
 """
 
+# directory for the wav files Qt plays and uploads read from,
+# created on first use and removed when the process exits
+_PLAYBACK_DIR = None
+
+def playback_file(suffix=".wav"):
+    """
+    path of a new empty file in the playback directory
+    """
+    global _PLAYBACK_DIR
+    if _PLAYBACK_DIR is None:
+        _PLAYBACK_DIR = tempfile.mkdtemp(prefix="audio_playback_")
+        atexit.register(shutil.rmtree, _PLAYBACK_DIR, True)
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=_PLAYBACK_DIR)
+    os.close(fd)
+    return path
+
 class Audio_File():
     """
     Base class for any audio file
-    - ensures wav format
-    - loads raw PCM via librosa into self.signal
-    - stores timing, duration, and Qt media
+    - decodes the audio once into a canonical PCM buffer, self.pcm,
+      of shape (frames, channels)
+    - derives the pydub segment (self.sound), mono float signal (self.signal,
+      as librosa.load gives it), int16 view (self.int16) and time axis
+      (self.time) from it on first use and keeps them
+    - ensures a wav copy for playback, stores duration and Qt media
     """
     def __init__(self, file, db=None, db_name=None):
-        # if database and name given, stream into a temp file
+        # if database and name given, stream the stored wav straight into memory,
+        # Qt only gets a copy of it to play
+        pcm = None
         if db and db_name:
-            temp = tempfile.NamedTemporaryFile(suffix=os.path.splitext(file)[1], delete=False)
-            db.read_one_audio_file_name(db_name, temp, temp=True)
-            self.file_path = temp.name
+            try:
+                pcm = db.read_audio_array(db_name)
+            except ValueError:
+                # payloads NumPy cannot view (e.g. an mp3 full track) are decoded from a file
+                pcm = None
+            if pcm is not None and pcm[0].dtype in (np.int16, np.int32):
+                self.file_path = playback_file()
+                self._write_wav(*pcm)
+            else:
+                pcm = None
+                self.file_path = playback_file(os.path.splitext(file)[1])
+                db.read_one_audio_file_name(db_name, self.file_path)
         else:
             self.file_path = os.path.abspath(file)
 
+        if pcm is None:
+            pcm = self._decode_file(self.file_path)
+        self.pcm, self.frame_rate = pcm
+        self.max_time = len(self.pcm) / self.frame_rate
+        self._sound = None
+        self._signal = None
+        self._int16 = None
+        self._time = None
+        self._max_vol = None
+
         # ensure wav
         if os.path.splitext(self.file_path)[1] != ".wav":
             self.convert_to_wav()
         
-        # load full audio segment for playback and envelope
-        self.sound = AudioSegment.from_wav(os.path.abspath(self.file_path))
-        self.max_time = self.sound.duration_seconds
-        self.max_vol = self.sound.max_dBFS
-        
         self.media = QMediaContent(QUrl.fromLocalFile(self.file_path))
-        
-        #self.time = []
-        #self.signal = []
-        self.signal, self.frame_rate = librosa.load(self.file_path, sr=None, mono=True)
-        self.time = np.linspace(0, self.max_time, num=len(self.signal))
-        
+
+    @staticmethod
+    def _decode_file(path):
+        """
+        decode an audio file into (integer PCM of shape (frames, channels), frame_rate)
+        wav files NumPy can view are not decoded at all
+        """
+        if os.path.splitext(path)[1] == ".wav":
+            with open(path, "rb") as f:
+                buf = f.read()
+            try:
+                data, frame_rate = parse_wav(buf)
+                if data.dtype in (np.int16, np.int32):
+                    return data, frame_rate
+            except ValueError:
+                pass
+        sound = AudioSegment.from_file(path)
+        dtype = {1: np.int8, 2: np.int16, 4: np.int32}[sound.sample_width]
+        return np.frombuffer(sound.raw_data, dtype=dtype).reshape(-1, sound.channels), sound.frame_rate
+
+    def _write_wav(self, data, frame_rate):
+        """write integer PCM of shape (frames, channels) to file_path"""
+        with wave.open(self.file_path, 'wb') as out:
+            out.setnchannels(data.shape[1])
+            out.setsampwidth(data.dtype.itemsize)
+            out.setframerate(frame_rate)
+            out.writeframes(data.tobytes())
+
+    @property
+    def sound(self):
+        """pydub AudioSegment of the audio, for playback and envelopes"""
+        if self._sound is None:
+            self._sound = AudioSegment(data=self.pcm.tobytes(), sample_width=self.pcm.dtype.itemsize,
+                                       frame_rate=self.frame_rate, channels=self.pcm.shape[1])
+        return self._sound
+
+    @sound.setter
+    def sound(self, sound):
+        self._sound = sound
+
+    @property
+    def signal(self):
+        """mono float32 signal in [-1, 1), the mean of the channels"""
+        if self._signal is None:
+            signal = self.pcm.T.astype(np.float32) / np.float32(2**(8*self.pcm.dtype.itemsize - 1))
+            self._signal = signal[0] if len(signal) == 1 else np.mean(signal, axis=0)
+        return self._signal
+
+    @signal.setter
+    def signal(self, signal):
+        self._signal = signal
+
+    @property
+    def int16(self):
+        """the PCM as 16 bit samples, a view of it when it already is"""
+        if self._int16 is None:
+            shift = 16 - 8*self.pcm.dtype.itemsize
+            if shift == 0:
+                self._int16 = self.pcm
+            elif shift < 0:
+                self._int16 = (self.pcm >> -shift).astype(np.int16)
+            else:
+                self._int16 = self.pcm.astype(np.int16) << shift
+        return self._int16
+
+    @property
+    def time(self):
+        """time (s) of each frame"""
+        if self._time is None:
+            self._time = np.linspace(0, self.max_time, num=len(self.pcm))
+        return self._time
+
+    @time.setter
+    def time(self, time):
+        self._time = time
+
+    @property
+    def max_vol(self):
+        """peak level in dBFS"""
+        if self._max_vol is None:
+            peak = int(np.max(np.abs(self.pcm.astype(np.int64)))) if self.pcm.size else 0
+            self._max_vol = ratio_to_db(peak, 2**(8*self.pcm.dtype.itemsize - 1))
+        return self._max_vol
+
+    @max_vol.setter
+    def max_vol(self, max_vol):
+        self._max_vol = max_vol
 
     def get_waveform(self, progress_callback=None):
         """
@@ -65,31 +187,36 @@ class Audio_File():
 
     def convert_to_wav(self):
         """
-        if file in mp3 format, write out same name.wav and change file path
+        if file in mp3 format, write the decoded PCM out as a wav and change file path
         """
-        sound = AudioSegment.from_mp3(self.file_path)
-        temp = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-        new_path = temp.name
-        #new_path = f"{os.path.splitext(self.file_path)[0]}.wav"
-        #if not(os.path.exists(new_path)):
-            #print(new_path)
-        sound.export(new_path, format="wav")
-        self.file_path = new_path
+        self.file_path = playback_file()
+        self._write_wav(self.pcm, self.frame_rate)
 
 class Original_Track_File(Audio_File):
     """
     Represents the original track in the project
         - has downbeat list from the database
         - keeps project context and an Audio_Recogniser
+        - owns the TrackSpectrum shared by every sample's Correlator
+        - tempo, downbeats, condensed waveform, display pyramid and track FFT
+          are kept in the AnalysisCache so reopening a project does not redo them
     """
-    def __init__(self, file, project_name, audio_recogniser, database):
+    def __init__(self, file, project_name, audio_recogniser, database, cache=None):
         super().__init__(file, db=database, db_name="full_track")
-        self.tempo = librosa.feature.tempo(y=self.signal, sr=self.frame_rate, start_bpm=60)[0]
+        if cache is None:
+            cache = AnalysisCache()
+        self.analysis = cache.entry(self.pcm, self.frame_rate)
+
+        self.tempo = float(self.analysis.get(
+            "tempo", lambda: librosa.feature.tempo(y=self.signal, sr=self.frame_rate, start_bpm=60)[0]))
         
-        self.condensed_signal = librosa.resample(y=self.signal, orig_sr=self.frame_rate, target_sr=self.frame_rate//4)
+        self.condensed_signal = self.analysis.get(
+            "condensed_signal", lambda: librosa.resample(y=self.signal, orig_sr=self.frame_rate, target_sr=self.frame_rate//4))
         self.condensed_time = np.linspace(0, self.max_time, num=len(self.condensed_signal))
 
-        self.downbeats = database.get_downbeats()
+        self.downbeats = self._load_downbeats(database)
+        self.pyramid = self._load_pyramid()
+        self.spectrum = TrackSpectrum(self.signal, cache=self.analysis)
         self.project_name=project_name
         self.audio_recogniser = audio_recogniser
     
@@ -99,6 +226,29 @@ class Original_Track_File(Audio_File):
         """
         return (self.condensed_time, self.condensed_signal)
 
+    def _load_downbeats(self, database):
+        """downbeats from the cache, or the database if not cached yet"""
+        downbeats = self.analysis.load("downbeats")
+        if downbeats is not None:
+            return downbeats.tolist()
+        downbeats = database.get_downbeats()
+        # tracks not yet through loop extraction have none, so nothing to keep
+        if len(downbeats) > 0:
+            self.analysis.save("downbeats", np.asarray(downbeats, dtype=float))
+        return downbeats
+
+    def _load_pyramid(self):
+        """min/max display pyramid of the signal, built and cached on first open"""
+        blocks = self.analysis.load("pyramid_blocks")
+        if blocks is not None:
+            levels = [(int(b), self.analysis.load(f"pyramid_{int(b)}")) for b in blocks]
+            if all(level is not None for _, level in levels):
+                return levels
+        levels = [(b, self.analysis.save(f"pyramid_{b}", level)) for b, level in minmax_pyramid(self.signal)]
+        # written last so a partly written pyramid is never read back
+        self.analysis.save("pyramid_blocks", np.array([b for b, _ in levels]))
+        return levels
+
 
 class Sample_File(Audio_File):
     """
@@ -108,12 +258,16 @@ class Sample_File(Audio_File):
         - finds offsets over threshold and repeats itself via Repeater
         - updates metadata stored in MongoDB if needed
     """
+    # kind of file the sample is stored as in the project database
+    kind = "extracted_sample"
+
     def __init__(self, file=None, name=None, full_track=None, database=None, rank=0, env_set=False, database_name=None):
         if database_name is None:
             database_name = name
         
         super().__init__(file, db=database, db_name=database_name)
         self.name = name
+        self.database_name = database_name
         self.rank = rank
         self.database = database
         self.full_track = full_track
@@ -121,16 +275,20 @@ class Sample_File(Audio_File):
         self.enveloped_file = self.file_path
         self.repeated_file = None
         self.repeated_media = None
+        self.repeater = None
         self.offsets = []
         self.val_arr = []
-        self.corr = [[],[]]
+        self.beat_corr = None
+        self._corr = None
+        self._peak_indexes = {}
 
         # prep correlator using original track
         self.correlator = Correlator(
             self.full_track.signal,
             self.full_track.frame_rate,
             self.full_track.max_time,
-            self.full_track.downbeats
+            self.full_track.downbeats,
+            self.full_track.spectrum
         )
 
         # if this sample is in database
@@ -167,13 +325,13 @@ class Sample_File(Audio_File):
         self.implement_envelope()
 
         # min/max corr for thresholding
-        if len(self.corr[1]) > 0:
+        if self.beat_corr is not None:
             if self.min_corr < 0:
-                self.min_corr = np.max(self.corr[1]) - 0.001
+                self.min_corr = self.beat_corr.max() - 0.001
                 self.max_corr = self.min_corr + 0.1
                 file_id = self.database.add_one_sample_file_with_env_list(self.name, self.file_path, self.get_envelope(), self.min_corr, [0 for i in range(len(self.time))])
             else:
-                self.max_corr = np.max(self.corr[1]) + 0.099
+                self.max_corr = self.beat_corr.max() + 0.099
         else:
             self.min_corr = 0
             self.max_corr = 0
@@ -184,8 +342,7 @@ class Sample_File(Audio_File):
         repeated_file_id = self.database.file_exists(f"{os.path.splitext(self.name)[0]}_repeated.wav")
         if repeated_file_id:
             #self.repeated_file =  self.get_repeated_sample_path()
-            temp = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-            self.repeated_file = temp.name
+            self.repeated_file = playback_file()
             self.database.read_one_audio_file_id(repeated_file_id, self.repeated_file)
             self.repeated_media = QMediaContent()
             self.repeated_media = QMediaContent(QUrl.fromLocalFile(self.repeated_file))
@@ -207,18 +364,42 @@ class Sample_File(Audio_File):
         self.min_corr = self.database.get_min_corr(database_name)
 
     def _initialise_metadata(self):
-        self.corr = self.correlator.beat_aligned(self.downbeat_probs)
+        self.beat_corr = self.correlator.beat_correlation(self.downbeat_probs)
+        self._corr = None
+        self._peak_indexes = {}
+
+    @property
+    def corr(self):
+        """
+        track-length (times, values) correlation curve for plotting,
+        only expanded from beat_corr the first time it is needed
+        """
+        if self._corr is None:
+            if self.beat_corr is None:
+                return [[],[]]
+            self._corr = self.beat_corr.dense()
+        return self._corr
+
+    def _peak_index(self, downsampled):
+        """
+        PeakIndex of the beat correlation (optionally block-downsampled),
+        built the first time that form is thresholded
+        """
+        if downsampled not in self._peak_indexes:
+            beat_corr = self.beat_corr
+            if downsampled:
+                time, probs = beat_corr.downsample()
+                gaps = lambda: beat_corr.gap_times(1000)
+            else:
+                time, probs = beat_corr.times, beat_corr.values
+                gaps = beat_corr.gap_times
+            self._peak_indexes[downsampled] = PeakIndex(time, probs, gaps)
+        return self._peak_indexes[downsampled]
     
     def _raw_signal_calc(self):
-        """load raw PCM from file_path"""
-        raw = wave.open(self.file_path)
-        n_frames = raw.getnframes()
-        frames = raw.readframes(n_frames)
-        signal = np.frombuffer(frames, dtype=np.int16)
-        n_channels = signal.size // n_frames
-        signal = signal.reshape(n_frames, n_channels)
-        self.signal = signal[:, 0]
-        self.frame_rate = raw.getframerate()    
+        """first channel of the decoded 16 bit PCM, its time axis and peak"""
+        n_frames = len(self.int16)
+        self.signal = self.int16[:, 0]
         self.time = np.linspace(0, n_frames/self.frame_rate, num=n_frames, endpoint=False)
         self.max_time = self.time[-1]
         self.max_vol = np.max(np.abs(self.signal))
@@ -244,8 +425,11 @@ class Sample_File(Audio_File):
         """
         if corr != self.min_corr:
             self.min_corr = corr
+            old_offsets = self.offsets
             self.update_offsets()
-            self.sample_repeat()
+            # only re-render if the threshold crossed a peak
+            if not np.array_equal(old_offsets, self.offsets):
+                self.sample_repeat()
     
     def get_envelope(self):
         """
@@ -313,11 +497,9 @@ class Sample_File(Audio_File):
         Generates x coords (offsets) and y_coords (val_arr) for green
         dots showing sample occurrences
         """
-        if len(self.corr[1]) > 0:
-            time, probs = self.corr[0], self.corr[1]
-            if self.min_corr < 3:
-                time, probs = self.correlator.downsample_corr(time, probs)
-            self.offsets, self.val_arr = self.correlator.threshold(time, probs, self.min_corr)
+        if self.beat_corr is not None:
+            peaks = self._peak_index(self.min_corr < 3)
+            self.offsets, self.val_arr = peaks.threshold(self.min_corr)
         else:
             self.offsets = []
             self.val_arr = []
@@ -331,8 +513,7 @@ class Sample_File(Audio_File):
             #base, _ = os.path.split(self.file_path)
             #path = os.path.dirname(base)
             #path = os.path.join(path, "enveloped_samples")
-            temp = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-            self.enveloped_file = temp.name
+            self.enveloped_file = playback_file()
         else:
             self.enveloped_file = os.path.join(path, f"{os.path.splitext(self.name)[0]}_enveloped.wav")
             if os.path.exists(self.enveloped_file):
@@ -342,6 +523,8 @@ class Sample_File(Audio_File):
 
         self.media = QMediaContent()
         self.media = QMediaContent(QUrl.fromLocalFile(self.enveloped_file))
+        # the sample audio changed so the repeated track is rendered from scratch
+        self.repeater = None
         if len(self.offsets) != 0:
             self.sample_repeat()
         return self.media
@@ -356,17 +539,21 @@ class Sample_File(Audio_File):
     def sample_repeat(self):
         """
         overlay sample repeats into a temp file via Repeater
+        the Repeater is kept between calls so a threshold change only
+        renders the occurrences that changed
         """
-        if self.enveloped_file != None:
-            sample = AudioSegment.from_wav(self.enveloped_file)
+        if self.repeater is None:
+            if self.enveloped_file != None:
+                sample = AudioSegment.from_wav(self.enveloped_file)
+            else:
+                sample = AudioSegment.from_wav(self.file_path)
+            self.repeater = Repeater(sample, self.offsets, self.full_track.max_time)
         else:
-            sample = AudioSegment.from_wav(self.file_path)
+            self.repeater.set_offsets(self.offsets)
         #self.repeated_file = self.get_repeated_sample_path()
-        temp = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
-        self.repeated_file = temp.name
+        self.repeated_file = playback_file()
         
-        repeater = Repeater(sample, self.offsets, self.full_track.max_time)
-        repeater.export(self.repeated_file)
+        self.repeater.export(self.repeated_file)
         
         file_id = self.database.add_repeat_sample_file(f"{os.path.splitext(self.name)[0]}_repeated.wav", self.repeated_file)
         self.repeated_media = QMediaContent()
@@ -378,13 +565,17 @@ class Sonic_Sample_File(Sample_File):
         - uppercase database name
         - use beat_aligned_sonic instead of beat_alligned
     """
+    kind = "sonic_sample"
+
     def __init__(self, file, name, full_track, database, rank):
         super().__init__(file, name, full_track, database, rank=rank, database_name=name.upper(), env_set=True)
     
     def _initialise_metadata(self):
         # sonic pi files has particular downbeats probs format in DB
         # due to different similarity measure
-        self.corr = self.correlator.beat_aligned_sonic(self.downbeat_probs, self.full_track.time)
+        self.beat_corr = self.correlator.beat_correlation_sonic(self.downbeat_probs, self.full_track.time)
+        self._corr = None
+        self._peak_indexes = {}
 
     """def implement_envelope(self, path=None):
         base, _ = os.path.split(self.full_track.file_path)
@@ -422,10 +613,8 @@ class Sonic_Sample_File(Sample_File):
         """
         sonic Pi similarity measure more noisy so downsample first
         """
-        if len(self.corr[1]) > 0:
-            time, probs = self.corr[0], self.corr[1]
-            time, probs = self.correlator.downsample_corr(time, probs)
-            self.offsets, self.val_arr = self.correlator.threshold(time, probs, self.min_corr)
+        if self.beat_corr is not None:
+            self.offsets, self.val_arr = self._peak_index(True).threshold(self.min_corr)
         else:
             self.offsets = []
             self.val_arr = []
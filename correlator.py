@@ -1,7 +1,208 @@
 import numpy as np
+import scipy.fft
 import scipy.signal
+from dataclasses import dataclass
 from typing import Tuple, Optional
 
+class TrackSpectrum:
+    """
+    spectral data of a track that is shared by every Correlator of that track
+    so the track FFT and energy are only computed once per track
+
+    Args:
+        track_signal : 1D numpy array of full track waveform
+        cache : optional TrackAnalysis the track FFTs are kept in between runs
+    """
+    def __init__(self, track_signal, cache=None):
+        self.track_signal = track_signal
+        self.cache = cache
+        self.energy = np.sum(np.abs(track_signal)**2)
+        self._spectra = {}
+        self._cumsum = None
+        self._cumsum_sq = None
+        self._decimated = {}
+
+    def fft_size(self, length=None):
+        """
+        padded FFT length used to correlate against the track
+        a length of at least the track length is enough for 'valid' mode
+        as none of the kept lags wrap around
+
+        Args:
+            length : minimum length required, defaults to track length
+        """
+        if length is None:
+            length = len(self.track_signal)
+        return scipy.fft.next_fast_len(int(length), real=True)
+
+    def rfft(self, n_fft):
+        """
+        real FFT of the track zero padded to n_fft, computed on first use
+
+        Args:
+            n_fft : padded FFT length
+        """
+        spectrum = self._spectra.get(n_fft)
+        if spectrum is None:
+            if self.cache is not None:
+                spectrum = self.cache.get(f"rfft_{n_fft}", lambda: scipy.fft.rfft(self.track_signal, n_fft))
+            else:
+                spectrum = scipy.fft.rfft(self.track_signal, n_fft)
+            self._spectra[n_fft] = spectrum
+        return spectrum
+
+    def window_sums(self, length):
+        """
+        sum and sum of squares of the track over every window of a given length,
+        taken from cumulative sums that are computed once per track
+
+        Args:
+            length : window length in samples
+        Returns:
+            sums, sq_sums : arrays of len(track) - length + 1
+        """
+        if self._cumsum is None:
+            x = np.asarray(self.track_signal, dtype=np.float64)
+            self._cumsum = np.concatenate(([0.0], np.cumsum(x)))
+            self._cumsum_sq = np.concatenate(([0.0], np.cumsum(x*x)))
+        sums = self._cumsum[length:] - self._cumsum[:-length]
+        sq_sums = self._cumsum_sq[length:] - self._cumsum_sq[:-length]
+        return sums, sq_sums
+
+    def decimated(self, factor):
+        """
+        TrackSpectrum of the track resampled to 1/factor of its rate,
+        built on first use and kept for later coarse searches
+
+        Args:
+            factor : integer decimation factor
+        """
+        spectrum = self._decimated.get(factor)
+        if spectrum is None:
+            spectrum = TrackSpectrum(scipy.signal.resample_poly(self.track_signal, 1, factor))
+            self._decimated[factor] = spectrum
+        return spectrum
+
+@dataclass
+class BeatCorrelation:
+    """
+    correlation curve that is zero everywhere except at a few track samples
+    (the downbeats), stored as those samples instead of a track-length array
+
+    Attributes:
+        indices : sorted, unique track sample index of each value
+        values : correlation value at each index
+        times : time (s) of each index on the track's time axis
+        n_samples : length of the equivalent dense curve
+        step : time (s) between consecutive samples of the dense curve
+    """
+    indices: np.ndarray
+    values: np.ndarray
+    times: np.ndarray
+    n_samples: int
+    step: float
+
+    def __len__(self):
+        return self.n_samples
+
+    def max(self):
+        """maximum of the dense curve, which includes the zeros between beats"""
+        if len(self.values) == 0:
+            return 0.0
+        if len(self.values) < self.n_samples:
+            return max(float(np.max(self.values)), 0.0)
+        return float(np.max(self.values))
+
+    def downsample(self, factor=1000):
+        """
+        same block maxima as Correlator.downsample_corr on the dense curve
+        but only for blocks that contain a beat
+
+        Returns:
+            new_times, new_corr : block mean times and block maxima
+        """
+        n_blocks = self.n_samples // factor
+        blocks = self.indices // factor
+        keep = blocks < n_blocks
+        blocks = blocks[keep]
+        values = self.values[keep]
+        if len(blocks) == 0:
+            return np.array([]), np.array([])
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(blocks)) + 1))
+        block_max = np.maximum.reduceat(values, starts)
+        # blocks that are not all beats also contain zeros
+        counts = np.diff(np.concatenate((starts, [len(blocks)])))
+        block_max = np.where(counts < factor, np.maximum(block_max, 0), block_max)
+        block_ids = blocks[starts]
+        block_times = (block_ids*factor + (factor - 1)/2)*self.step
+        return block_times, block_max
+
+    def gap_times(self, factor=None):
+        """
+        times of the zeros of the dense curve that the compact form leaves out,
+        i.e. every sample (or with factor, every block) without a beat
+
+        Args:
+            factor : block size of the downsampled curve, None for the dense curve
+        Returns:
+            array of times, sample times or block mean times as downsample gives them
+        """
+        if factor is None:
+            return np.delete(np.arange(self.n_samples)*self.step, self.indices)
+        n_blocks = self.n_samples // factor
+        blocks = np.delete(np.arange(n_blocks), self.indices // factor)
+        return (blocks*factor + (factor - 1)/2)*self.step
+
+    def dense(self):
+        """
+        expand into the track-length (times, values) curve, used for plotting
+        """
+        time = np.arange(0, self.n_samples, 1)*self.step
+        probs = np.zeros(self.n_samples)
+        probs[self.indices] = self.values
+        return time, probs
+
+class PeakIndex:
+    """
+    correlation values sorted once so that picking every time above
+    a threshold is a binary search, used when the min-corr slider moves
+
+    Args:
+        times : time (s) of each value
+        values : correlation values
+        gaps : optional function returning the times of the zeros left out of
+               times, e.g. BeatCorrelation.gap_times, only called once a
+               threshold at or below zero would pick them too
+    """
+    def __init__(self, times, values, gaps=None):
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=float)
+        keep = (times > 0) & ~np.isnan(values)
+        order = np.argsort(values[keep], kind='stable')
+        self.values = values[keep][order]
+        self.times = np.round(times[keep][order], 2)
+        self._gaps = gaps
+        self._gap_times = None
+
+    def threshold(self, min_corr):
+        """
+        same result as Correlator.threshold on the dense curve, given gaps
+
+        Returns:
+            offsets : unique times with value >= min_corr
+            values : array of min corr
+        """
+        start = np.searchsorted(self.values, min_corr, side='left')
+        offsets = self.times[start:]
+        if min_corr <= 0 and self._gaps is not None:
+            if self._gap_times is None:
+                gap_times = np.asarray(self._gaps(), dtype=float)
+                self._gap_times = np.round(gap_times[gap_times > 0], 2)
+            offsets = np.concatenate((offsets, self._gap_times))
+        offsets = np.unique(offsets)
+        val_arr = np.repeat(min_corr, len(offsets))
+        return offsets, val_arr
+
 class Correlator:
     """
     all similarity based analysis between a sample and the track
@@ -11,30 +212,248 @@ class Correlator:
         sr : sample rate of both track and samples
         track_max_time: duration (s) of the track
         downbeats : optional array of downbeat times
+        spectrum : optional TrackSpectrum of track_signal shared between correlators
     """
-    def __init__(self, track_signal, sr, track_max_time, downbeats=None):
+    def __init__(self, track_signal, sr, track_max_time, downbeats=None, spectrum=None):
         self.track_signal = track_signal
         self.sr = sr
         self.track_max_time = track_max_time
         self.downbeats = downbeats
+        if spectrum is None:
+            spectrum = TrackSpectrum(track_signal)
+        self.spectrum = spectrum
+
+    def valid_correlation(self, sample_signal):
+        """
+        un-normalised 'valid' mode cross-correlation of the track with a sample
+        using the cached track spectrum so only the sample is transformed
+
+        Returns:
+            correlation of length len(track) - len(sample) + 1
+        """
+        n = len(self.track_signal)
+        m = len(sample_signal)
+        if m > n:
+            return scipy.signal.correlate(self.track_signal, sample_signal, mode='valid', method='fft')
+        n_fft = self.spectrum.fft_size()
+        sample_fft = scipy.fft.rfft(sample_signal, n_fft)
+        c = scipy.fft.irfft(self.spectrum.rfft(n_fft) * np.conj(sample_fft), n_fft)
+        return c[:n - m + 1]
+
+    def local_correlation(self, sample_signal):
+        """
+        sliding-window normalised cross-correlation (Pearson correlation
+        of the sample with every track window of the same length)
+        window energies come from the track's cumulative sums so the cost
+        stays that of one FFT correlation
 
-    def full_correlation(self, sample_signal, lp_cutoff = 35.0, lp_order = 15):
+        Returns:
+            correlation values in [-1, 1], 0 where the track window is silent
+        """
+        m = len(sample_signal)
+        if m > len(self.track_signal):
+            raise ValueError("Sample is longer than the track")
+        sample_zero_mean = sample_signal - np.mean(sample_signal)
+        sample_energy = np.sum(sample_zero_mean**2)
+        # the sample has zero mean so the window means cancel out of the numerator
+        c = self.valid_correlation(sample_zero_mean)
+        sums, sq_sums = self.spectrum.window_sums(m)
+        window_energy = np.maximum(sq_sums - sums**2/m, 0)
+        denom = np.sqrt(window_energy*sample_energy)
+        ncc = np.zeros(len(c))
+        if sample_energy > 0:
+            np.divide(c, denom, out=ncc, where=window_energy > 1e-8*np.max(window_energy))
+        return np.clip(ncc, -1, 1)
+
+    def full_correlation(self, sample_signal, lp_cutoff = 35.0, lp_order = 15, normalisation = "track"):
         """
         computes normalised cross-correlation (FFT) between the track and a sample
         then apply low-pass filter to smooth it
 
+        Args:
+            normalisation : "track" divides by the energy of the whole track,
+                "local" uses the sliding-window NCC of local_correlation so
+                scores lie in [-1, 1] and are comparable across tracks
         Returns:
             times : array of times in seconds
             corr : filtered, normalised correlation values
         """
-        c = scipy.signal.correlate(self.track_signal, sample_signal, mode='valid', method='fft')
-        c /= np.sqrt(np.sum(np.abs(sample_signal)**2)*np.sum(np.abs(self.track_signal)**2))
+        if normalisation == "local":
+            c = self.local_correlation(sample_signal)
+        else:
+            c = self.valid_correlation(sample_signal)
+            c /= np.sqrt(np.sum(np.abs(sample_signal)**2)*self.spectrum.energy)
         sos = scipy.signal.butter(lp_order, lp_cutoff, 'lp', fs=1000, output='sos') 
         filtered = scipy.signal.sosfiltfilt(sos, c) 
+        if normalisation == "local":
+            filtered = np.clip(filtered, -1, 1)
         offsets = np.arange(0, len(c), 1)/self.sr
         self.last_full_calc = (offsets, filtered)
         return offsets, filtered
-    
+
+    def correlate_many(self, samples, lp_cutoff = 35.0, lp_order = 15, batch_size = 8):
+        """
+        batched full_correlation for several samples
+        samples are zero padded into a 2D array so each batch needs one
+        rFFT/irFFT pass, rows of equal length are low-pass filtered together
+
+        Args:
+            samples : list of 1D sample signals
+            batch_size : number of samples transformed at once (bounds memory)
+        Returns:
+            list of (times, corr) pairs, same order and values as full_correlation
+        """
+        n = len(self.track_signal)
+        n_fft = self.spectrum.fft_size()
+        track_fft = self.spectrum.rfft(n_fft)
+        sos = scipy.signal.butter(lp_order, lp_cutoff, 'lp', fs=1000, output='sos')
+        results = [None] * len(samples)
+
+        batched = [i for i, s in enumerate(samples) if len(s) <= n]
+        for i, s in enumerate(samples):
+            if len(s) > n:
+                results[i] = self.full_correlation(s, lp_cutoff, lp_order)
+
+        for b in range(0, len(batched), batch_size):
+            idx = batched[b:b + batch_size]
+            lengths = np.array([len(samples[i]) for i in idx])
+            padded = np.zeros((len(idx), np.max(lengths)), dtype=np.result_type(*[samples[i] for i in idx], np.float32))
+            for row, i in enumerate(idx):
+                padded[row, :lengths[row]] = samples[i]
+            sample_fft = scipy.fft.rfft(padded, n_fft, axis=-1)
+            c = scipy.fft.irfft(track_fft * np.conj(sample_fft), n_fft, axis=-1)
+            c /= np.sqrt(np.sum(np.abs(padded)**2, axis=-1)*self.spectrum.energy)[:, np.newaxis]
+            for m in np.unique(lengths):
+                rows = np.flatnonzero(lengths == m)
+                filtered = scipy.signal.sosfiltfilt(sos, c[rows, :n - m + 1], axis=-1)
+                offsets = np.arange(0, n - m + 1, 1)/self.sr
+                for row, f in zip(rows, filtered):
+                    results[idx[row]] = (offsets, f)
+
+        if len(results) > 0:
+            self.last_full_calc = results[-1]
+        return results
+
+    def streaming_correlation(self, sample_signal, factor=1000, block_size=2**18, margin=2048, lp_cutoff = 35.0, lp_order = 15):
+        """
+        overlap-save version of full_correlation followed by downsample_corr
+        the track is correlated in blocks and only the block maxima are kept,
+        so peak memory depends on block_size rather than the track length
+
+        each block is extended by margin correlation values on both sides
+        before low-pass filtering so the forward-backward filter sees the
+        same context as a pass over the whole curve; the margin must cover
+        the filter's impulse response (2048 is ample for the default filter)
+
+        Args:
+            sample_signal : 1D sample waveform
+            factor : downsampling factor, as in downsample_corr
+            block_size : correlation values produced per block (rounded to a multiple of factor)
+            margin : extra correlation values either side of a block used for filtering
+        Returns:
+            new_times, new_corr : same as downsample_corr(*full_correlation(sample_signal))
+        """
+        n = len(self.track_signal)
+        m = len(sample_signal)
+        if m > n:
+            return self.downsample_corr(*self.full_correlation(sample_signal, lp_cutoff, lp_order), factor=factor)
+        n_corr = n - m + 1
+        n_out = n_corr // factor
+        block = max(factor, (block_size // factor) * factor)
+
+        sos = scipy.signal.butter(lp_order, lp_cutoff, 'lp', fs=1000, output='sos')
+        norm = np.sqrt(np.sum(np.abs(sample_signal)**2)*self.spectrum.energy)
+        sample_ffts = {}
+
+        probs = np.empty(n_out)
+        for start in range(0, n_out*factor, block):
+            stop = min(start + block, n_out*factor)
+            filtered = self._filtered_block(sample_signal, start, stop, margin, sos, norm, sample_ffts)
+            probs[start//factor:stop//factor] = filtered.reshape(-1, factor).max(axis=1)
+        times = (np.arange(n_out)*factor + (factor - 1)/2)/self.sr
+        return times, probs
+
+    def _filtered_block(self, sample_signal, start, stop, margin, sos, norm, sample_ffts):
+        """
+        normalised, low-pass filtered correlation values for lags [start, stop)
+        computed from the track segment they need plus margin lags either side
+
+        Args:
+            sample_ffts : dict of conjugated sample spectra by FFT size, filled in as needed
+        """
+        m = len(sample_signal)
+        n_corr = len(self.track_signal) - m + 1
+        # correlation values [lo, hi) are computed, [start, stop) are kept
+        lo = max(0, start - margin)
+        hi = min(n_corr, stop + margin)
+        n_fft = self.spectrum.fft_size(hi - lo + m - 1)
+        sample_fft = sample_ffts.get(n_fft)
+        if sample_fft is None:
+            sample_fft = np.conj(scipy.fft.rfft(sample_signal, n_fft))
+            sample_ffts[n_fft] = sample_fft
+        segment = self.track_signal[lo:hi + m - 1]
+        c = scipy.fft.irfft(scipy.fft.rfft(segment, n_fft) * sample_fft, n_fft)[:hi - lo]
+        c /= norm
+        return scipy.signal.sosfiltfilt(sos, c)[start - lo:stop - lo]
+
+    def coarse_to_fine_correlation(self, sample_signal, min_corr, decimation=8, tolerance=0.002, margin=2048, lp_cutoff = 35.0, lp_order = 15):
+        """
+        approximate full_correlation that only works at full rate where it matters
+        the track and sample are first correlated at 1/decimation of the sample rate,
+        then only lags whose coarse value is within tolerance of min_corr are
+        recomputed at full rate; everywhere else the coarse curve is interpolated
+
+        tolerance is the accuracy knob: a larger tolerance refines more of the
+        curve, and last_refined_fraction records how much was refined
+
+        Args:
+            sample_signal : 1D sample waveform
+            min_corr : threshold the offsets will be picked with
+            decimation : rate reduction of the coarse pass
+            tolerance : how far below min_corr a coarse value may be and still be refined
+            margin : extra lags either side of a refined region used for filtering
+        Returns:
+            times, corr : same form as full_correlation
+        """
+        n = len(self.track_signal)
+        m = len(sample_signal)
+        if m > n or m < 2*decimation:
+            return self.full_correlation(sample_signal, lp_cutoff, lp_order)
+        if lp_cutoff >= 500/decimation:
+            raise ValueError("Low-pass cutoff too high for the decimation factor")
+        n_corr = n - m + 1
+
+        # coarse pass: the filter is designed so it smooths the same span of time
+        coarse_spectrum = self.spectrum.decimated(decimation)
+        coarse_sample = scipy.signal.resample_poly(sample_signal, 1, decimation)
+        coarse = Correlator(coarse_spectrum.track_signal, self.sr/decimation, self.track_max_time, spectrum=coarse_spectrum)
+        c = coarse.valid_correlation(coarse_sample)
+        c /= np.sqrt(np.sum(np.abs(coarse_sample)**2)*coarse_spectrum.energy)
+        coarse_sos = scipy.signal.butter(lp_order, lp_cutoff, 'lp', fs=1000/decimation, output='sos')
+        coarse_corr = scipy.signal.sosfiltfilt(coarse_sos, c)
+
+        lags = np.arange(0, n_corr, 1)
+        corr = np.interp(lags, np.arange(len(coarse_corr))*decimation, coarse_corr)
+
+        # fine pass over every candidate region, widened by one coarse step
+        candidates = np.flatnonzero(coarse_corr >= min_corr - tolerance)
+        refined = 0
+        if len(candidates) > 0:
+            starts = np.maximum((candidates - 1)*decimation, 0)
+            stops = np.minimum((candidates + 2)*decimation, n_corr)
+            breaks = np.flatnonzero(starts[1:] > stops[:-1])
+            sos = scipy.signal.butter(lp_order, lp_cutoff, 'lp', fs=1000, output='sos')
+            norm = np.sqrt(np.sum(np.abs(sample_signal)**2)*self.spectrum.energy)
+            sample_ffts = {}
+            for start, stop in zip(starts[np.concatenate(([0], breaks + 1))], stops[np.concatenate((breaks, [len(stops) - 1]))]):
+                corr[start:stop] = self._filtered_block(sample_signal, start, stop, margin, sos, norm, sample_ffts)
+                refined += stop - start
+        self.last_refined_fraction = refined / n_corr
+
+        offsets = lags/self.sr
+        self.last_full_calc = (offsets, corr)
+        return offsets, corr
+
     def get_correlation_histogram(self, offsets, binwidth = 0.1):
         """
         Build a histogram of manually-detected match offsets
@@ -94,6 +513,56 @@ class Correlator:
         val_arr = np.repeat(min_corr, len(offsets))
         return offsets, val_arr
 
+    def _compact(self, indices, values, times, step):
+        """
+        build a BeatCorrelation, dropping indices past the end of the track
+        and keeping the last value written to a repeated index
+        """
+        n = len(self.track_signal)
+        indices = np.asarray(indices, dtype=np.int64)
+        values = np.broadcast_to(np.asarray(values, dtype=float), indices.shape)
+        times = np.asarray(times, dtype=float)
+        keep = indices < n
+        indices, values, times = indices[keep], values[keep], times[keep]
+        # unique keeps the first occurrence so search from the end
+        _, last = np.unique(indices[::-1], return_index=True)
+        last = len(indices) - 1 - last
+        return BeatCorrelation(indices[last], values[last], times[last], n, step)
+
+    def beat_correlation(self, downbeat_probs):
+        """
+        compact form of beat_aligned: one value per downbeat instead of a
+        track-length array, built without allocating the track's time axis
+
+        Returns:
+            BeatCorrelation
+        """
+        if self.downbeats is None:
+            raise RuntimeError("No downbeats provided")
+        beats = np.asarray(self.downbeats[:-1], dtype=float)
+        # first sample whose time index/sr is at or after each downbeat
+        idx = np.maximum(np.ceil(beats*self.sr).astype(np.int64), 0)
+        idx[(idx > 0) & ((idx - 1)/self.sr >= beats)] -= 1
+        idx[idx/self.sr < beats] += 1
+        return self._compact(idx, downbeat_probs, idx/self.sr, 1/self.sr)
+
+    def beat_correlation_sonic(self, downbeat_probs, time):
+        """
+        compact form of beat_aligned_sonic
+
+        Args:
+            downbeat_probs : [match times, match probabilities] as stored for Sonic Pi samples
+            time : the track's time axis
+        Returns:
+            BeatCorrelation
+        """
+        if self.downbeats is None:
+            raise RuntimeError("No downbeats provided")
+        idx = np.searchsorted(time, downbeat_probs[0][:-1])
+        times = time[np.minimum(idx, len(time) - 1)]
+        step = time[-1]/(len(time) - 1) if len(time) > 1 else 0.0
+        return self._compact(idx, downbeat_probs[1], times, step)
+
     def beat_aligned(self, downbeat_probs):
         """
         if downbeats was provided, sample correlation only at those beat times
@@ -102,12 +571,7 @@ class Correlator:
         Returns:
             (beat_times, beat_corrs)
         """
-        if self.downbeats is None:
-            raise RuntimeError("No downbeats provided")
-        time = np.arange(0, len(self.track_signal), 1)/self.sr
-        probs = np.zeros(time.shape)
-        probs[np.searchsorted(time, self.downbeats[:-1])] = downbeat_probs
-        return time, np.array(probs)
+        return self.beat_correlation(downbeat_probs).dense()
     
     def beat_aligned_sonic(self, downbeat_probs, time):
         """
@@ -118,10 +582,4 @@ class Correlator:
         Returns:
             (beat_times, beat_corrs)
         """
-        if self.downbeats is None:
-            raise RuntimeError("No downbeats provided")
-        n = len(self.track_signal)
-        probs = np.zeros(n+1, dtype=float)
-        probs[np.searchsorted(time, downbeat_probs[0][:-1])] = downbeat_probs[1]
-        probs = probs[:-1]
-        return (time, np.array(probs))
\ No newline at end of file
+        return self.beat_correlation_sonic(downbeat_probs, time).dense()
\ No newline at end of file
@@ -23,12 +23,15 @@ class EnvelopeProcessor:
     """
     Apply ADSR envelop to a pydub AudioSegment
 
-    - convert level -> dB for pydub fades
-    - slice the source audio into segments
-    - insert leading/trailing silence if needed
-    - apply fade-in/out between each pair of envelope points
+    - convert level -> dB -> linear gain for each envelope point
+    - build the gain for every frame with np.interp between the points
+    - silence everything before the start point and after the release point
+    - multiply the samples by the gain once
     - return new AudioSegment with envelope applied
     """
+    # numpy types of the pcm sample widths pydub uses
+    _PCM_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
     def __init__(self, sound):
         self.sound = sound
         self.max_vol = sound.max
@@ -49,7 +52,27 @@ class EnvelopeProcessor:
         else:
             dB = np.round(20*np.log10(rel),3)
         return dB
-            
+
+    def gain_curve(self, env):
+        """
+        linear gain for every frame of the sound
+        gain ramps linearly in amplitude between envelope points
+        (the same shape pydub's fade produces) and is zero outside
+        the start - release span
+
+        Args:
+            env: envelope with absolute times (secs) and levels (0-1)
+
+        Returns:
+            1D array of gains, one per frame
+        """
+        env_points = [env.start, env.attack, env.decay, env.sustain, env.release]
+        times = np.array([p.time for p in env_points], dtype=float)
+        gains = np.array([10**(self._level_to_db(p.level)/20) for p in env_points])
+        frame_times = np.arange(int(self.sound.frame_count()))/self.sound.frame_rate
+        gain = np.interp(frame_times, times, gains)
+        gain[(frame_times < times[0]) | (frame_times >= times[-1])] = 0
+        return gain
 
     def implement_envelope(self, env):
         """
@@ -61,22 +84,17 @@ class EnvelopeProcessor:
         Returns:
             new AudioSegment with envelope applied
         """
-        #new_sound = AudioSegment.silent(duration=int(env.start.time*1000))
-        chunks = [] 
-        silent_start = AudioSegment.silent(duration=int(1000*env.start.time))
-        chunks.append(silent_start)
-        
-        env_points = [env.start, env.attack, env.decay, env.sustain, env.release]
-        for p1, p2 in zip(env_points, env_points[1:]):
-            chunk = self.sound[int(1000*p1.time): int(1000*p2.time)]
-            dB1 = self._level_to_db(p1.level)
-            dB2 = self._level_to_db(p2.level)
-            if p1.time != p2.time and len(chunk) > 0:
-                chunk = chunk.fade(to_gain=dB2, from_gain=dB1, start=0, end=len(chunk))
-            chunks.append(chunk)
-        end_ms = env_points[-1].time*1000
-        if end_ms < len(self.sound):
-            silent_end = AudioSegment.silent(duration=len(self.sound)-int(end_ms))
-            chunks.append(silent_end)
-        new_sound = sum(chunks)
-        return new_sound
\ No newline at end of file
+        dtype = self._PCM_DTYPES.get(self.sound.sample_width)
+        if dtype is None:
+            # 24 bit audio has no numpy type so work in 32 bit
+            sound = self.sound.set_sample_width(4)
+            dtype = np.int32
+        else:
+            sound = self.sound
+        info = np.iinfo(dtype)
+        samples = np.frombuffer(sound.raw_data, dtype=dtype).reshape(-1, sound.channels)
+        new_samples = np.floor(samples * self.gain_curve(env)[:, np.newaxis])
+        np.clip(new_samples, info.min, info.max, out=new_samples)
+        new_sound = AudioSegment(data=new_samples.astype(dtype).tobytes(), sample_width=sound.sample_width,
+                                 frame_rate=sound.frame_rate, channels=sound.channels)
+        return new_sound
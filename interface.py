@@ -35,8 +35,9 @@ from program_generator import LoopProgramGenerator, DSLProgramGenerator
 from draggable_item import DraggableItem
 from loop_extractor import LoopExtractor
 from audio_graph import Audio_Graph
+from repeat_processor import StemMixer
 from audio_database import ProjectDatabase
-from pymongo import MongoClient
+from storage_backend import default_storage
 from audio_recogniser import Audio_Recogniser
 from load_window import LoadWindow
 
@@ -90,14 +91,14 @@ class MainWindow(QMainWindow):
         self.checked_samples = []
         self.checked_sonic_pi_samples = []
 
-        # mongoDB connection
+        # database storage, MongoDB through the process-wide shared client by default
         try:
-            self.client = MongoClient("localhost", 27017)
+            self.storage = default_storage()
         except Exception as e:
             self.show_error_msg(QMessageBox.Icon.Critical, 
                                  "Database Error", 
                                  f"Cannot connect to MongoDB: \n{e}")
-            self.client = None
+            self.storage = None
 
         # audio processors
         self.audio_recogniser = Audio_Recogniser()
@@ -230,6 +231,7 @@ class MainWindow(QMainWindow):
         - a header label "SAMPLES"
         - two scrollable grids: extracted samples and built-in Sonic Pi samples
         - a "GENERATE" button to synthesize final Sonic Pi program
+        - a "PREVIEW REMIX" button to mix the checked samples into a wav with a stem per sample
         """
         #scroll area for list of samples
         self.scroll_samp = QScrollArea()
@@ -262,6 +264,12 @@ class MainWindow(QMainWindow):
         self.generate_button.setEnabled(False)
         self.generate_button.clicked.connect(self.generate_program)
         self.sample_panel.addWidget(self.generate_button)
+
+        #button to render a preview of the remix
+        self.preview_button = QPushButton("PREVIEW REMIX")
+        self.preview_button.setEnabled(False)
+        self.preview_button.clicked.connect(self.preview_remix)
+        self.sample_panel.addWidget(self.preview_button)
     
     def _create_right_layout(self):
         """
@@ -509,7 +517,7 @@ class MainWindow(QMainWindow):
     def update_track_graph_dat(self):
         # update track waveform
         if self.current_project != "":
-            self.track_line.getData(self.original_track.signal, self.original_track.frame_rate)
+            self.track_line.getData(self.original_track.signal, self.original_track.frame_rate, self.original_track.pyramid)
     
     def update_corr_graph_dat(self):
         # update similarity measure
@@ -522,8 +530,10 @@ class MainWindow(QMainWindow):
         self.current_project_path = f"uploaded_projects/{item.text()}"
         # update original track
         self.original_track_path = self.get_track()
-        # find database
+        # find database, with the metadata of every file in one query
+        # so the samples below are looked up in memory
         self.current_database = ProjectDatabase(self.current_project)
+        self.current_database.get_catalogue()
         # update samples and clear current graphs
         self.current_sample = None
         self.sample_line.getData([])
@@ -533,6 +543,7 @@ class MainWindow(QMainWindow):
         self.set_original_track()
         self.set_sample_list()
         self.generate_button.setEnabled(True)
+        self.preview_button.setEnabled(True)
 
     def set_original_track(self, val=None):
         # change original track being worked with
@@ -570,16 +581,15 @@ class MainWindow(QMainWindow):
     def get_project_names(self):
         #get names of uploaded projects
         try:
-            if not self.client:
+            if not self.storage:
                 return
             try:
-                projects = self.client.list_database_names()
+                projects = self.storage.names()
             except Exception as e:
                 self.show_error_msg(QMessageBox.Icon.Warning, "DB Query Failed", str(e))
                 return
-            unwanted = ["admin", "config", "local", "SonicPiSamples"]
-            for u in unwanted:
-                projects.remove(u)
+            unwanted = ["SonicPiSamples", "AudioBlobs"]
+            projects = [p for p in projects if p not in unwanted]
         except Exception as error:
             print("Error with getting uploaded projects:", error)
             return []
@@ -881,7 +891,7 @@ class MainWindow(QMainWindow):
     
     def change_min_corr(self):
         # update the minimum correlation for the current sample
-        self.current_database.update_sample_data(self.current_sample)
+        self.current_database.update_sample_data(self.current_sample, audio_changed=False)
         # update the intersection points on the graph
         self.corr_intersection_points.clear()
         self.corr_intersection_points.addPoints(self.current_sample.offsets, self.current_sample.val_arr)
@@ -977,7 +987,7 @@ class MainWindow(QMainWindow):
 
         self.current_sample.set_env_with_list([env_x, env_y])
         self.env_line.setData(env_x, env_y)
-        self.current_database.update_sample_data(self.current_sample)
+        self.current_database.update_sample_data(self.current_sample, audio_changed=False)
         # update sample audio to implement new envelope
         self.audio_sample_player.setMedia(QMediaContent())
         self.audio_sample_player.setMedia(self.current_sample.implement_envelope())
@@ -1053,6 +1063,8 @@ class MainWindow(QMainWindow):
                 track_name = os.listdir(f"{self.current_project_path}/full_track")[0]
                 self.original_track_path = f"{self.current_project_path}/full_track/{track_name}"
                 self.current_database = ProjectDatabase(project_name)
+                # empty for a new project, extraction adds each file it stores
+                self.current_database.get_catalogue()
 
             except OSError as e:
                 self.show_error_msg(QMessageBox.Icon.Critical, "Filesystem Error", f"could not make new project folder:\n{e}")
@@ -1098,6 +1110,36 @@ class MainWindow(QMainWindow):
             self.splash_screen.close()
             self.generate_button.setEnabled(True)
     
+    def preview_remix(self):
+        """
+        Render a preview of the remix from the currently checked samples
+        method called when user clicks "PREVIEW REMIX" button
+        """
+        self.preview_button.setEnabled(False)
+        self.splash_screen = LoadWindow(self)
+        self.splash_screen.show()
+        try:
+            self.export_remix_preview()
+        except Exception as e:
+            self.show_error_msg(QMessageBox.Icon.Critical, "Preview Error", f"Could not render remix preview:\n{e}")
+        finally:
+            self.splash_screen.close()
+            self.preview_button.setEnabled(True)
+
+    def export_remix_preview(self):
+        """
+        mix every checked sample at its offsets into remix_preview.wav in the
+        project folder, and each one alone into stems/, in one pass over the track
+        """
+        samples = self.checked_samples + self.checked_sonic_pi_samples
+        if len(samples) == 0:
+            return
+        stem_dir = os.path.join(self.current_project_path, "stems")
+        os.makedirs(stem_dir, exist_ok=True)
+        stem_paths = [os.path.join(stem_dir, f"{os.path.splitext(os.path.basename(s.name))[0]}.wav") for s in samples]
+        mixer = StemMixer.from_sample_files(samples, self.original_track.max_time)
+        mixer.export(os.path.join(self.current_project_path, "remix_preview.wav"), stem_paths)
+
     def create_temp_ui(self):
         # temporary UI while it was being developed
         left_panel_pixmap = QPixmap("UI/left_panel.jpg")
@@ -1,86 +1,235 @@
-from loopextractor.loopextractor.loopextractor.loopextractor import make_spectral_cube, validate_template_sizes, create_loop_spectrum, get_loop_signal
+from loopextractor.loopextractor.loopextractor.loopextractor import make_spectral_cube, validate_template_sizes
 import os
 import librosa
 import soundfile
-import tensorly.decomposition as tld
+from tucker_decomposition import non_negative_tucker
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import madmom
 from pydub import AudioSegment
 import gridfs
 from io import BytesIO
 from audio_recogniser import Audio_Recogniser
+from upload_queue import UploadQueue
+from analysis_cache import PipelineCache, file_hash
+from loop_reconstruction import (share_array, init_worker, reconstruct_shared_loop,
+                                 reconstruct_loop, choose_bar_to_reconstruct, estimate_source_signal)
 
 """
 Implements LoopExtactor
     - loads audio file and detects downbeat times via madmom
     - segments the signal into bars and build spectral cube
-    - applies non-negative Tucker decomposition via TensorLy
+    - applies non-negative Tucker decomposition (tucker_decomposition, on TensorLy)
     - reconstruct individual loop components and writes them into GridFS
+    - caches the output of each of those stages (PipelineCache) so reruns
+      only redo the stages whose inputs changed
     - matches each separated loop against a library of Sonic Pi samples
-    - stores extracted loops and matched samples with metadata in MongoDB
+    - stores extracted loops and matched samples with metadata in MongoDB,
+      uploading in the background (UploadQueue) while extraction continues
+    - reconstructs the loops in parallel worker processes (loop_reconstruction)
 """
 
 class LoopExtractor:
     """
     Attributes:
         n_templates : [n_sounds, n_rhythms, n_loops] initial template counts
+        n_iter_max : iteration limit of the Tucker decomposition
+        n_workers : processes loops are reconstructed on, None for one per CPU
+        tol : the decomposition stops once an iteration improves its relative error by less than this fraction
         audio_recogniser: helper to match separated loops to Sonic Pi samples
+        stages : PipelineCache keeping the output of each stage of the algorithm
     """
-    def __init__(self, n_templates=[0,0,0]):
+    def __init__(self, n_templates=[0,0,0], stages=None):
         assert len(n_templates)==3
         assert type(n_templates) is list
         self.n_templates = n_templates
+        self.n_iter_max = 500
+        self.tol = 1e-4
+        self.n_workers = None
         self.audio_recogniser = Audio_Recogniser()
+        self.stages = stages if stages is not None else PipelineCache()
     
     def run_algorithm(self, audio_file, output_savename, output_folder, database, original_track_creation):
         """
         Loop extraction as implemented by loopextractor but with additional 
         database operations
+
+        the computation is split into stages whose outputs are kept in
+        self.stages, each keyed by its inputs, so a rerun only recomputes the
+        stages whose inputs changed (e.g. new n_templates reuses the downbeats and cube):
+            track, downbeats -> cube -> tucker -> reconstruct -> matches
+        the decomposition also starts from the first one of the same cube
+        database uploads are not cached and always run
         """
         assert os.path.exists(audio_file)
+        source = file_hash(audio_file)
         # Load mono audio:
-        signal_mono, fs = librosa.load(audio_file, sr=None, mono=True)
+        track = self.stages.run("track", [source], lambda: self.load_track(audio_file))
+        fs = int(track["fs"])
         # Use madmom to estimate the downbeat times:
-        downbeat_times = self.get_downbeats(audio_file)
+        downbeats = self.stages.run("downbeats", [source],
+                                    lambda: {"downbeats": np.array(self.get_downbeats(audio_file), dtype=float)})
+        downbeat_times = downbeats["downbeats"].tolist()
         print(downbeat_times)
         self.initialise_full_track_file(downbeat_times, audio_file, database)
         original_track_creation.emit(50)
-        # Convert times to frames so we segment signal:
-        downbeat_frames = librosa.time_to_samples(downbeat_times, sr=fs)
-        #print(downbeat_times)
-        # Create spectral cube out of signal:
-        spectral_cube = make_spectral_cube(signal_mono, downbeat_frames)
+        # loudness every extracted sample is raised to
+        full_track_dbfs = float(track["dbfs"])
+        # Create spectral cube out of signal, segmented at the downbeat frames:
+        cube = self.stages.run("cube", [track.key, downbeats.key], lambda: {
+            "spectral_cube": make_spectral_cube(track["signal"], librosa.time_to_samples(downbeat_times, sr=fs))
+        })
+        spectral_cube = cube["spectral_cube"]
+        # its magnitude, used by every stage after; cheap to recompute, so kept
+        # in memory rather than cached next to the cube
+        magnitude = np.abs(spectral_cube)
+        # non-negative Tucker decomposition, warm started from the first one of this cube:
+        params = [list(self.n_templates), self.n_iter_max, self.tol]
+        warm_start = self.stages.load("tucker_warm_start", [cube.key])
+        if warm_start is not None and "source" not in warm_start.arrays:
+            # kept before warm starts recorded the run they came from
+            warm_start = None
+        first = warm_start is None
+        if not first and str(warm_start["params"]) == repr(params):
+            # the warm start is these parameters' own cold run
+            warm_start = None
+        # where it started is an input of the decomposition, so the key of the
+        # run the warm start came from is part of the stage key
+        warm_source = str(warm_start["source"]) if warm_start is not None else None
+        tucker = self.stages.run("tucker", [cube.key, *params, warm_source],
+                                 lambda: self.decompose(magnitude, warm_start))
+        if first:
+            self.stages.save("tucker_warm_start", [cube.key],
+                             dict(tucker.arrays, source=np.array(tucker.key), params=np.array(repr(params))))
+        core = tucker["core"]
+        factors = [tucker["sounds"], tucker["rhythms"], tucker["loops"]]
+        n_loops = core.shape[2]
+        # uploads run on background threads while the next loop is reconstructed,
+        # leaving the block waits for all of them
+        with UploadQueue() as uploads:
+            separated_loop_files = {}
+            def upload(i, full_loop, bar_probs, loop_signal):
+                separated_loop_files[i] = self.upload_loop(i, full_loop, bar_probs, loop_signal, fs, output_savename,
+                                                           full_track_dbfs, database, uploads)
+            reconstructed = self.stages.run("reconstruct", [tucker.key, cube.key],
+                                            lambda: self.reconstruct_loops(core, factors, spectral_cube, magnitude, upload))
+            if reconstructed.cached:
+                for i in range(n_loops):
+                    upload(i, reconstructed[f"full_loop_{i}"], reconstructed[f"bar_probs_{i}"], reconstructed[f"loop_signal_{i}"])
+            # sonic pi matching reads the separated loops back so needs them stored
+            separated_loop_files = [separated_loop_files[i].result() for i in range(n_loops)]
+            matches = self.stages.run("matches", [reconstructed.key],
+                                      lambda: self.match_loops(database, separated_loop_files, float(track["duration"])))
+            self.initialise_sonic_sample_files(database, matches, uploads)
+
+    def load_track(self, audio_file):
+        """
+        decode the track
+
+        Returns:
+            dict of mono signal, sample rate, duration (s) and loudness (dBFS)
+        """
+        signal_mono, fs = librosa.load(audio_file, sr=None, mono=True)
+        return {
+            "signal": signal_mono,
+            "fs": np.array(fs),
+            "duration": np.array(librosa.get_duration(y=signal_mono, sr=fs)),
+            "dbfs": np.array(AudioSegment.from_file(audio_file).dBFS),
+        }
+
+    def decompose(self, magnitude, warm_start=None):
+        """
+        non-negative Tucker decomposition of the spectral cube
+
+        Args:
+            magnitude : magnitude of the spectral cube
+            warm_start : optional outputs of an earlier decomposition to start from,
+                         truncated or expanded to the template counts
+        Returns:
+            dict of core, sounds, rhythms and loops factors,
+            and the reconstruction error and time (s) of each iteration
+        """
         # Validate the input n_templates (inventing new ones if any is wrong):
-        n_sounds, n_rhythms, n_loops = validate_template_sizes(spectral_cube, self.n_templates)
-        # Use TensorLy to do the non-negative Tucker decomposition:
-        core, factors = tld.non_negative_tucker(np.abs(spectral_cube), [n_sounds, n_rhythms, n_loops], n_iter_max=500, verbose=True)
-        #sounds = factors[0]
-        #rhythms = factors[1]
-        #loops = factors[2]
-        separated_loop_files = []
-        # Reconstruct each loop:
-        for ith_loop in range(n_loops):
-            # Multiply templates together to get real loop spectrum:
-            loop_spectrum = create_loop_spectrum(factors[0], factors[1], core[:,:,ith_loop])
-            # Choose best bar to reconstruct from (we will use its phase):
-            bar_ind, bar_probs = self.choose_bar_to_reconstruct(factors[2], ith_loop, loop_spectrum, spectral_cube)
-            norm_bar_prob = (bar_probs - np.min(bar_probs)) / (np.max(bar_probs) - np.min(bar_probs))
-            norm_bar_prob *= 100
-            #print(norm_bar_prob)
-            full_loop = self.estimate_source_signal(bar_probs, loop_spectrum, spectral_cube)
-            #file = os.path.join(output_folder, f"separated_loop_{ith_loop}.wav")
-            #soundfile.write(file, full_loop, fs)
-            file = self.initialise_loop_file(database, full_loop, fs, ith_loop)
-            separated_loop_files.append(file)
-            #bar_probs = factors[2][:,:ith_loop]
-            # Reconstruct loop signal by masking original spectrum:
-            ith_loop_signal = get_loop_signal(factors[2][:,ith_loop][bar_ind]*loop_spectrum, spectral_cube[:,:,bar_ind])
-            # Write signal to disk:
-            soundfile.write("{0}_{1}.wav".format(output_savename,ith_loop), ith_loop_signal, fs)
-            #print(downbeat_times[bar_ind])
-            self.initialise_sample_file(10, norm_bar_prob, f"sample_{ith_loop}.wav", audio_file, database, "{0}_{1}.wav".format(output_savename,ith_loop), 0)
-        track_length = librosa.get_duration(y=signal_mono, sr=fs)
-        self.initialise_sonic_sample_files(database, separated_loop_files, track_length)
+        n_sounds, n_rhythms, n_loops = validate_template_sizes(magnitude, self.n_templates)
+        init = None
+        if warm_start is not None:
+            init = (warm_start["core"], [warm_start["sounds"], warm_start["rhythms"], warm_start["loops"]])
+        core, factors, rec_errors, iter_times = non_negative_tucker(
+            magnitude, [n_sounds, n_rhythms, n_loops], init=init,
+            n_iter_max=self.n_iter_max, tol=self.tol, verbose=True
+        )
+        return {"core": core, "sounds": factors[0], "rhythms": factors[1], "loops": factors[2],
+                "rec_errors": rec_errors, "iter_times": iter_times}
+
+    def reconstruct_loops(self, core, factors, spectral_cube, magnitude, on_loop=None):
+        """
+        reconstruct each loop from the decomposition
+        loops are independent so are spread over a pool of self.n_workers processes,
+        which read core, factors, spectral cube and its magnitude from shared memory
+
+        Args:
+            on_loop : optional callback(i, full_loop, bar_probs, loop_signal) run,
+                      in loop order, as each loop is done so its uploads start early
+        Returns:
+            dict of full_loop_i, bar_probs_i and loop_signal_i for each loop i
+        """
+        n_loops = core.shape[2]
+        n_workers = min(self.n_workers or os.cpu_count() or 1, n_loops)
+        if n_workers <= 1:
+            results = (self.reconstruct_loop(i, core, factors, spectral_cube, magnitude) for i in range(n_loops))
+            return self._collect_loops(results, on_loop)
+
+        arrays = {"core": core, "sounds": factors[0], "rhythms": factors[1], "loops": factors[2],
+                  "spectral_cube": spectral_cube, "magnitude": magnitude}
+        blocks = {}
+        try:
+            for name, array in arrays.items():
+                blocks[name] = share_array(array)
+            descriptors = {name: (shm.name, shape, dtype) for name, (shm, shape, dtype) in blocks.items()}
+            # spawned rather than forked: this runs on a Qt worker thread and forking
+            # a threaded process can copy locks other threads hold (Qt, BLAS, pymongo)
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=init_worker, initargs=(descriptors,)) as pool:
+                results = (f.result() for f in [pool.submit(reconstruct_shared_loop, i) for i in range(n_loops)])
+                return self._collect_loops(results, on_loop)
+        finally:
+            for shm, _, _ in blocks.values():
+                shm.close()
+                shm.unlink()
+
+    def _collect_loops(self, results, on_loop):
+        """gather (full_loop, bar_probs, loop_signal) of each loop in order into the stage outputs"""
+        loops = {}
+        for ith_loop, (full_loop, bar_probs, ith_loop_signal) in enumerate(results):
+            loops[f"full_loop_{ith_loop}"] = full_loop
+            loops[f"bar_probs_{ith_loop}"] = np.asarray(bar_probs)
+            loops[f"loop_signal_{ith_loop}"] = ith_loop_signal
+            if on_loop is not None:
+                on_loop(ith_loop, full_loop, bar_probs, ith_loop_signal)
+        return loops
+
+    # per-loop work, in loop_reconstruction so worker processes import only that
+    reconstruct_loop = staticmethod(reconstruct_loop)
+    choose_bar_to_reconstruct = staticmethod(choose_bar_to_reconstruct)
+    estimate_source_signal = staticmethod(estimate_source_signal)
+
+    def upload_loop(self, ith_loop, full_loop, bar_probs, loop_signal, fs, output_savename, full_track_dbfs, database, uploads):
+        """
+        queue a reconstructed loop's separated loop and sample for upload
+
+        Returns:
+            Future of the separated loop file ID
+        """
+        norm_bar_prob = (bar_probs - np.min(bar_probs)) / (np.max(bar_probs) - np.min(bar_probs))
+        norm_bar_prob *= 100
+        #print(norm_bar_prob)
+        #file = os.path.join(output_folder, f"separated_loop_{ith_loop}.wav")
+        #soundfile.write(file, full_loop, fs)
+        file = self.initialise_loop_file(database, full_loop, fs, ith_loop, uploads)
+        self.initialise_sample_file(10, norm_bar_prob, f"sample_{ith_loop}.wav", full_track_dbfs, database, "{0}_{1}.wav".format(output_savename,ith_loop),
+                                    loop_signal, fs, 0, uploads)
+        return file
 
     def get_downbeats(self, file):
         """
@@ -96,46 +245,11 @@ class LoopExtractor:
         
         return downbeats
 
-    def choose_bar_to_reconstruct(self, loop_templates, ith_loop, loop_spectrum, spectral_cube):
-        """
-        Select the best bar index whose phase will be used for reconstruction
-        Computes softmask-weighted loudness metric per bar
-        (same as loopextractor except added the softmask weights)
-        """
-        loudness_time_softmask= []
-        for b in range(len(loop_templates[:,:ith_loop])):
-            original_spectrum = spectral_cube[:,:,b]
-            min_length = np.min((loop_spectrum.shape[1], original_spectrum.shape[1]))
-            orig_mag, orig_phase = librosa.magphase(original_spectrum)
-            mask = librosa.util.softmask(loop_spectrum[:,:min_length], orig_mag[:,:min_length], power=1)
-            loudness_time_softmask.append(loop_templates[:,ith_loop][b]*np.sum(mask))
-        #bar_prev = np.argmax(loop_templates[:,ith_loop])
-        bar_ind = np.argmax(loudness_time_softmask)
-        #print(f"{bar_prev},{bar_ind}")
-        return bar_ind, loudness_time_softmask
-
-    def estimate_source_signal(self, bar_probs, loop_spectrum, spectral_cube):
-        """
-        produce full loop time-domain signal
-        """
-        full_signal = []
-        for b in range(len(bar_probs)):
-            original_spectrum = spectral_cube[:,:,b]
-            min_length = np.min((loop_spectrum.shape[1], original_spectrum.shape[1]))
-            mag = loop_spectrum * bar_probs[b]
-            orig_mag, orig_phase = librosa.magphase(original_spectrum)
-            mask = librosa.util.softmask(mag[:,:min_length], orig_mag[:,:min_length], power=1)
-            masked_spectrum = original_spectrum[:,:min_length] * mask
-            signal = librosa.core.istft(masked_spectrum)
-            full_signal.append(signal)
-        loop_signal = np.concatenate(full_signal)
-        return loop_signal
-    
     def initialise_full_track_file(self, downbeats, file, database):
         """store the original track with doenbeat meta data"""
         database.add_full_track_file(file, downbeats)
     
-    def write_sample_file(self, min_prob, bar_probs, name, database, rank, original_vol, sound):
+    def write_sample_file(self, min_prob, bar_probs, name, database, rank, original_vol, sound, file=None, uploads=None):
         """
         stream AudioSegment into GridFS database and record metadata
 
@@ -147,6 +261,10 @@ class LoopExtractor:
             rank:   sample rank (always 0 for extracted loop)
             original_vol: original y coordinate for A,D,S of ADSR
             sound: AudioSegment instance for sample
+            file:   optional path to also save the sample to on disk
+            uploads:    UploadQueue to store the sample from in the background
+        Returns:
+            file ID, or a Future of it if uploads is given
         """
         buf = BytesIO()
         sound.export(buf, format="wav")
@@ -157,39 +275,61 @@ class LoopExtractor:
         decay = (0,original_vol)
         sustain = (max_time,original_vol)
         release = (max_time,0)
-        database.add_one_sample_file(name, buf, start, attack, decay, sustain, release, min_prob, list(bar_probs), rank, buf=True)
+        bar_probs = list(bar_probs)
+
+        def store():
+            if file is not None:
+                with open(file, "wb") as out:
+                    out.write(buf.getbuffer())
+            return database.add_one_sample_file(name, buf, start, attack, decay, sustain, release, min_prob, bar_probs, rank, buf=True)
+        if uploads is None:
+            return store()
+        return uploads.submit(store)
     
-    def initialise_sample_file(self, min_prob, bar_probs, name, full_track, database, file, rank=0):
+    def initialise_sample_file(self, min_prob, bar_probs, name, full_track_dbfs, database, file, signal, fs, rank=0, uploads=None):
         """
-        set extract loop to have same peak level as the full track
-        and delete on-disk file then write sample to database
+        set extract loop to have same loudness as the full track,
+        then save sample to file and write it to database, all from memory
 
         Args:
             min_prob:   min correlation threshold for sample
             bar_probs:  list of downbeat probabilities
             name:   name to store sample in database under
-            full_track: path for original track
+            full_track_dbfs: loudness of the original track in dBFS
             database:   ProjectDatabase instance
-            fille:  path to temp wav file for sample
+            file:  path to save wav file for sample to
+            signal, fs: reconstructed loop signal and its sample rate
             rank:   sample rank (always 0 for extracted loop)
+            uploads:    UploadQueue to store the sample from in the background
+        Returns:
+            file ID, or a Future of it if uploads is given
         """
-        sound = AudioSegment.from_file(file)
-        full_track_sound = AudioSegment.from_file(full_track)
+        # gain and encoding run on the upload thread too
+        if uploads is not None:
+            return uploads.submit(self.initialise_sample_file, min_prob, bar_probs, name, full_track_dbfs,
+                                  database, file, signal, fs, rank)
+        # same 16 bit wav soundfile would write to disk
+        wav = BytesIO()
+        wav.name = "file.wav"
+        soundfile.write(wav, signal, fs)
+        wav.seek(0)
+        sound = AudioSegment.from_wav(wav)
         original_vol = sound.max
-        if sound.dBFS < full_track_sound.dBFS:
-            sound = sound.apply_gain(full_track_sound.dBFS - sound.dBFS)
-        os.remove(file)
-        sound.export(out_f=file, format="wav")
+        if sound.dBFS < full_track_dbfs:
+            sound = sound.apply_gain(full_track_dbfs - sound.dBFS)
 
-        self.write_sample_file(min_prob, bar_probs, name, database, rank, original_vol, sound)
+        return self.write_sample_file(min_prob, bar_probs, name, database, rank, original_vol, sound, file, uploads)
             
-    def initialise_loop_file(self, database, loop, fs, i):
+    def initialise_loop_file(self, database, loop, fs, i, uploads=None):
         """
         write numpy array into in-memory buffer,
         and store as separated_loop_idx
         Returns:
-            assigned file ID
+            assigned file ID, or a Future of it if uploads is given
         """
+        # encoded on the upload thread too
+        if uploads is not None:
+            return uploads.submit(self.initialise_loop_file, database, loop, fs, i)
         buf = BytesIO()
         buf.name = "file.wav"
         soundfile.write(buf, loop, fs)
@@ -197,21 +337,36 @@ class LoopExtractor:
         file_id = database.add_source_separated_loop(f"separated_loop_{i}", buf)
         return file_id
 
-    def initialise_sonic_sample_files(self, database, files, track_length):
+    def match_loops(self, database, files, track_length):
         """
         match each separated loop against the Sonic Pi sample library
-        then store the match locations and score of matches as new sample files
+
+        Returns:
+            dict of names (matched samples, best first) and bins_i, counts_i
+            histogram of match locations for each
         """
         matched_sonic_samples = self.audio_recogniser.compare_separated_loops(track_length, database, file_ids = files)
-        for i, s in enumerate(matched_sonic_samples.keys()):
+        matches = {"names": np.array(list(matched_sonic_samples.keys()), dtype=str)}
+        for i, hist in enumerate(matched_sonic_samples.values()):
+            matches[f"bins_{i}"] = np.asarray(hist[0])
+            matches[f"counts_{i}"] = np.asarray(hist[1])
+        return matches
+
+    def initialise_sonic_sample_files(self, database, matches, uploads=None):
+        """
+        store the match locations and score of matches (see match_loops) as new sample files
+        (in the background if an UploadQueue is given)
+        """
+        for i, s in enumerate(matches["names"]):
+            s = str(s)
             file = os.path.abspath(f"sample-pi-main/{s.lower()}")
-            hist = matched_sonic_samples[s]
-            min_prob = float(np.max(hist[1]))
+            bins, counts = matches[f"bins_{i}"], matches[f"counts_{i}"]
+            min_prob = float(np.max(counts))
             min_prob -= 0.5
             min_prob = max(0.5, min_prob)
             #print(min_prob)
             sound = AudioSegment.from_file(file)
-            self.write_sample_file(min_prob, [list(hist[0]), list(hist[1])], s, database, i+1, sound.max, sound)
+            self.write_sample_file(min_prob, [bins.tolist(), counts.tolist()], s, database, i+1, sound.max, sound, uploads=uploads)
 
 #l = LoopExtractor()
 #l.run_algorithm("C:/Users/uno4e/OneDrive/Documents/Cambridge II/project/music/sax_ehrling.mp3", "", "", None, None)
@@ -0,0 +1,101 @@
+from loopextractor.loopextractor.loopextractor.loopextractor import create_loop_spectrum, get_loop_signal
+import librosa
+import numpy as np
+from multiprocessing import shared_memory
+
+"""
+Per-loop reconstruction for LoopExtractor
+kept apart from loop_extractor (and anything importing Qt, madmom or the
+databases) as it is what the reconstruction worker processes import:
+    - reconstruct_loop and the bar scoring / source estimation it uses
+    - shared memory set up for the worker processes (share_array, init_worker)
+"""
+
+# arrays shared with the loop reconstruction workers, name -> (SharedMemory, view)
+_shared = {}
+
+def share_array(array):
+    """
+    copy an array into a new shared memory block
+
+    Returns:
+        SharedMemory, shape, dtype string to reopen it with
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, array.shape, array.dtype.str
+
+def init_worker(descriptors):
+    """attach a worker process to the shared arrays, read-only"""
+    for name, (shm_name, shape, dtype) in descriptors.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        view.flags.writeable = False
+        _shared[name] = (shm, view)
+
+def reconstruct_shared_loop(ith_loop):
+    """reconstruct_loop on the shared arrays"""
+    arrays = {name: view for name, (_, view) in _shared.items()}
+    factors = [arrays["sounds"], arrays["rhythms"], arrays["loops"]]
+    return reconstruct_loop(ith_loop, arrays["core"], factors, arrays["spectral_cube"], arrays["magnitude"])
+
+def reconstruct_loop(ith_loop, core, factors, spectral_cube, magnitude):
+    """
+    reconstruct one loop from the decomposition
+
+    Args:
+        magnitude : np.abs(spectral_cube), computed once per extraction
+
+    Returns:
+        full_loop : loop signal over the whole track
+        bar_probs : softmask weighted loudness of the loop in each bar
+        loop_signal : loop signal of its best bar
+    """
+    # Multiply templates together to get real loop spectrum:
+    loop_spectrum = create_loop_spectrum(factors[0], factors[1], core[:,:,ith_loop])
+    # Choose best bar to reconstruct from (we will use its phase):
+    bar_ind, bar_probs = choose_bar_to_reconstruct(factors[2], ith_loop, loop_spectrum, magnitude)
+    full_loop = estimate_source_signal(bar_probs, loop_spectrum, spectral_cube, magnitude)
+    #bar_probs = factors[2][:,:ith_loop]
+    # Reconstruct loop signal by masking original spectrum:
+    ith_loop_signal = get_loop_signal(factors[2][:,ith_loop][bar_ind]*loop_spectrum, spectral_cube[:,:,bar_ind])
+    #print(downbeat_times[bar_ind])
+    return full_loop, bar_probs, ith_loop_signal
+
+def choose_bar_to_reconstruct(loop_templates, ith_loop, loop_spectrum, magnitude):
+    """
+    Select the best bar index whose phase will be used for reconstruction
+    Computes softmask-weighted loudness metric per bar
+    (same as loopextractor except added the softmask weights)
+    the softmask of every bar is taken in one broadcast over the bar axis
+
+    Args:
+        magnitude : magnitude of the spectral cube (frequency, time, bar)
+    """
+    min_length = min(loop_spectrum.shape[1], magnitude.shape[1])
+    orig_mag = magnitude[:,:min_length,:]
+    loop_mag = np.broadcast_to(loop_spectrum[:,:min_length,np.newaxis], orig_mag.shape)
+    mask = librosa.util.softmask(loop_mag, orig_mag, power=1)
+    loudness_time_softmask = loop_templates[:,ith_loop] * np.sum(mask, axis=(0,1))
+    #bar_prev = np.argmax(loop_templates[:,ith_loop])
+    bar_ind = np.argmax(loudness_time_softmask)
+    #print(f"{bar_prev},{bar_ind}")
+    return bar_ind, loudness_time_softmask
+
+def estimate_source_signal(bar_probs, loop_spectrum, spectral_cube, magnitude):
+    """
+    produce full loop time-domain signal
+    every bar is masked in one broadcast and inverted in one batched ISTFT
+
+    Args:
+        magnitude : magnitude of the spectral cube (frequency, time, bar)
+    """
+    min_length = min(loop_spectrum.shape[1], spectral_cube.shape[1])
+    mag = loop_spectrum[:,:min_length,np.newaxis] * np.asarray(bar_probs)[np.newaxis,np.newaxis,:]
+    mask = librosa.util.softmask(mag, magnitude[:,:min_length,:], power=1)
+    masked_spectrum = spectral_cube[:,:min_length,:] * mask
+    # bars first, istft works over the last two axes
+    signals = librosa.core.istft(np.moveaxis(masked_spectrum, 2, 0))
+    loop_signal = signals.reshape(-1)
+    return loop_signal
@@ -1,9 +1,12 @@
-from PyQt5.QtWidgets import QApplication
-from qt_material import apply_stylesheet
-from interface import MainWindow
 import sys
 
 def main():
+    # imported here so the spawned loop reconstruction workers,
+    # which import this module, do not load Qt and the whole UI
+    from PyQt5.QtWidgets import QApplication
+    from qt_material import apply_stylesheet
+    from interface import MainWindow
+
     app = QApplication(sys.argv)
 
     window = MainWindow()
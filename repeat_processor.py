@@ -1,12 +1,26 @@
 from pydub import AudioSegment
 import numpy as np
+import wave
 import os
 
+# numpy types for the pcm sample widths the mixer handles
+# and the wider types their sums are accumulated in;
+# pydub loads 8 bit audio as signed and widens 24 bit to 32 bit, and overlaying
+# onto its 16 bit silence widens 8 bit, so the output is always one of these.
+# Any other width is overlaid by pydub itself
+_PCM_DTYPES = {2: (np.int16, np.int32), 4: (np.int32, np.int64)}
+
 class Repeater:
     """
     Overlay a sample repeatedly over a silent track
     of a given duration at specified offsets
 
+    the sample is decoded once into a numpy array and added into one
+    preallocated buffer at each offset, then clipped to the sample width;
+    the buffer is kept so changing offsets only adds or removes the
+    occurrences that changed; sample widths without a numpy type in
+    _PCM_DTYPES fall back to overlaying with pydub
+
     Attributes:
         sample  : pydub AudioSegment containing single sample
         offsets : 1D array of times in seconds at which to play the sample
@@ -16,7 +30,114 @@ class Repeater:
         self.sample = sample
         self.offsets = np.sort(np.unique(offsets))
         self.track_duration = track_duration
-    
+        # decoded sample, mix buffer and the offsets currently added into it
+        self._sample_data = None
+        self._mix = None
+        self._mixed_offsets = np.array([])
+
+    def set_offsets(self, offsets):
+        """
+        change the offsets the sample is played at
+        the next render only adds or removes the occurrences that changed
+
+        Args:
+            offsets : 1D array of times in seconds
+        """
+        self.offsets = np.sort(np.unique(offsets))
+
+    def _decode(self):
+        """
+        decode the sample and work out the output format and length
+        which follow pydub overlaying the sample onto AudioSegment.silent
+        """
+        silent = AudioSegment.silent(duration=0)
+        self.channels = max(silent.channels, self.sample.channels)
+        self.frame_rate = max(silent.frame_rate, self.sample.frame_rate)
+        self.sample_width = max(silent.sample_width, self.sample.sample_width)
+        self.mixable = self.sample_width in _PCM_DTYPES
+        if self.mixable:
+            sample = self.sample.set_channels(self.channels).set_frame_rate(self.frame_rate).set_sample_width(self.sample_width)
+            dtype, acc_dtype = _PCM_DTYPES[self.sample_width]
+            self._sample_data = np.frombuffer(sample.raw_data, dtype=dtype).reshape(-1, self.channels).astype(acc_dtype)
+        else:
+            self._sample_data = np.zeros((0, self.channels), dtype=np.int64)
+
+        self.len_ms = int(self.track_duration*1000)
+        # frames in AudioSegment.silent(len_ms) once pydub resamples it to frame_rate,
+        # pydub then works in whole milliseconds of that, which sets the output length
+        silent_frames = int(silent.frame_rate * (self.len_ms / 1000.0))
+        g = np.gcd(silent.frame_rate, self.frame_rate)
+        resampled_frames = ((silent_frames - 1)*(self.frame_rate//g))//(silent.frame_rate//g) + 1 if silent_frames > 0 else 0
+        resampled_ms = int(round(1000*resampled_frames/self.frame_rate))
+        self.out_frames = int(min(self.len_ms, resampled_ms) * (self.frame_rate / 1000.0))
+
+    def decoded(self):
+        """
+        the sample in the output format, decoded on first use
+        channels, frame_rate, sample_width and out_frames are set once it is
+
+        Returns:
+            (frames, channels) array in the accumulation type of the sample width
+        """
+        if self._sample_data is None:
+            self._decode()
+        return self._sample_data
+
+    def positions(self, offsets=None):
+        """
+        first output frame of each occurrence that starts inside the track
+
+        Args:
+            offsets : times in seconds, defaults to self.offsets
+        """
+        self.decoded()
+        if offsets is None:
+            offsets = self.offsets
+        pos_ms = (np.asarray(offsets, dtype=float) * 1000).astype(np.int64)
+        pos_ms = pos_ms[(pos_ms >= 0) & (pos_ms < self.len_ms)]
+        return (pos_ms * (self.frame_rate / 1000.0)).astype(np.int64)
+
+    def _add(self, offsets, sign):
+        """add (sign=1) or remove (sign=-1) the sample at each offset"""
+        for start in self.positions(offsets):
+            stop = min(start + len(self._sample_data), self.out_frames)
+            if sign > 0:
+                self._mix[start:stop] += self._sample_data[:stop - start]
+            else:
+                self._mix[start:stop] -= self._sample_data[:stop - start]
+
+    def render(self):
+        """
+        bring the mix buffer up to date with self.offsets
+
+        Returns:
+            interleaved pcm array of the repeated track, clipped to the sample width
+        Raises:
+            ValueError if the sample width has no numpy type (see sample_repeat)
+        """
+        self.decoded()
+        if not self.mixable:
+            raise ValueError(f"no numpy mixer for {self.sample_width} byte samples")
+        if self._mix is None:
+            self._mix = np.zeros((self.out_frames, self.channels), dtype=self._sample_data.dtype)
+            self._mixed_offsets = np.array([])
+        self._add(np.setdiff1d(self._mixed_offsets, self.offsets), -1)
+        self._add(np.setdiff1d(self.offsets, self._mixed_offsets), 1)
+        self._mixed_offsets = self.offsets
+
+        dtype, _ = _PCM_DTYPES[self.sample_width]
+        info = np.iinfo(dtype)
+        return np.clip(self._mix, info.min, info.max).astype(dtype)
+
+    def _overlay(self):
+        """pydub overlay of the sample at each offset, for widths the mixer lacks"""
+        sound = AudioSegment.silent(duration=self.len_ms)
+        for off in self.offsets:
+            pos_ms = int(off * 1000)
+            if 0 <= pos_ms < self.len_ms:
+                sound = sound.overlay(self.sample, position=pos_ms)
+        return sound[:self.len_ms]
+
     def sample_repeat(self):
         """
         render and return new AudioSegment of length track_duration
@@ -25,21 +146,146 @@ class Repeater:
         Returns:
             AudioSegment: the repeated sample track
         """
-        len_ms = int(self.track_duration*1000)
-        sound = AudioSegment.silent(duration=len_ms)
-        for off in self.offsets:
-            pos_ms = int(off * 1000)
-            if 0 <= pos_ms < len_ms:
-                sound = sound.overlay(self.sample, position=pos_ms)
-        return sound[:len_ms]
-    
+        self.decoded()
+        if not self.mixable:
+            return self._overlay()
+        pcm = self.render()
+        return AudioSegment(data=pcm.tobytes(), sample_width=self.sample_width, frame_rate=self.frame_rate, channels=self.channels)
+
     def export(self, path, format = "wav"):
         """
         render and write repeated track to destination
-        
+        wav is written straight from the mix buffer
+
         Args:
             path : destination filepath
             format : audio format
         """
-        repeated = self.sample_repeat()
-        repeated.export(path, format=format)
\ No newline at end of file
+        self.decoded()
+        if format != "wav" or not self.mixable:
+            self.sample_repeat().export(path, format=format)
+            return
+        pcm = self.render()
+        with wave.open(path, 'wb') as out:
+            out.setnchannels(self.channels)
+            out.setsampwidth(self.sample_width)
+            out.setframerate(self.frame_rate)
+            out.writeframes(pcm.tobytes())
+
+
+class StemMixer:
+    """
+    Mix several repeated samples (the checked samples of a project) into a
+    remix preview and per-sample stems in one pass over the track
+
+    every stem is rendered by a Repeater in a shared format; the output is
+    produced chunk by chunk so only one chunk of the mix is ever held
+
+    Attributes:
+        repeaters : one Repeater per stem
+        track_duration : total length of output in seconds
+        chunk_seconds : length of each rendered chunk
+    """
+    def __init__(self, samples, offsets, track_duration, chunk_seconds=10):
+        """
+        Args:
+            samples : list of pydub AudioSegments, one per stem
+            offsets : list of offset arrays (s), one per stem
+            track_duration : total length of output in seconds
+            chunk_seconds : length of each rendered chunk
+        """
+        silent = AudioSegment.silent(duration=0)
+        channels = max([silent.channels] + [s.channels for s in samples])
+        frame_rate = max([silent.frame_rate] + [s.frame_rate for s in samples])
+        sample_width = max([silent.sample_width] + [s.sample_width for s in samples])
+        if sample_width not in _PCM_DTYPES:
+            raise ValueError(f"no numpy mixer for {sample_width} byte samples")
+        # convert up front so every Repeater works in the same format
+        self.repeaters = [
+            Repeater(s.set_channels(channels).set_frame_rate(frame_rate).set_sample_width(sample_width), off, track_duration)
+            for s, off in zip(samples, offsets)
+        ]
+        self.track_duration = track_duration
+        self.chunk_seconds = chunk_seconds
+
+    @classmethod
+    def from_sample_files(cls, sample_files, track_duration, chunk_seconds=10):
+        """
+        build a mixer from Sample_File / Sonic_Sample_File instances
+        using their enveloped audio and current offsets
+        """
+        samples = []
+        for f in sample_files:
+            if f.repeater is not None:
+                samples.append(f.repeater.sample)
+            elif f.enveloped_file != None:
+                samples.append(AudioSegment.from_wav(f.enveloped_file))
+            else:
+                samples.append(AudioSegment.from_wav(f.file_path))
+        return cls(samples, [f.offsets for f in sample_files], track_duration, chunk_seconds)
+
+    def chunks(self, stems=False):
+        """
+        render the track chunk by chunk
+
+        Args:
+            stems : also return each stem's chunk
+        Yields:
+            mix : interleaved pcm chunk of the remix, clipped to the sample width
+            stem_chunks : list of pcm chunks, one per stem (None if stems is False)
+        """
+        if len(self.repeaters) == 0:
+            return
+        samples = [r.decoded() for r in self.repeaters]
+        first = self.repeaters[0]
+        out_frames, channels = first.out_frames, first.channels
+        dtype, acc_dtype = _PCM_DTYPES[first.sample_width]
+        info = np.iinfo(dtype)
+        chunk_frames = max(1, int(self.chunk_seconds * first.frame_rate))
+        positions = [r.positions() for r in self.repeaters]
+
+        for c0 in range(0, out_frames, chunk_frames):
+            c1 = min(c0 + chunk_frames, out_frames)
+            mix = np.zeros((c1 - c0, channels), dtype=acc_dtype)
+            stem_chunks = [] if stems else None
+            for data, starts in zip(samples, positions):
+                stem = np.zeros_like(mix) if stems else mix
+                # occurrences that overlap [c0, c1)
+                lo = np.searchsorted(starts, c0 - len(data), side='right')
+                hi = np.searchsorted(starts, c1, side='left')
+                for start in starts[lo:hi]:
+                    a = max(start, c0)
+                    b = min(start + len(data), c1)
+                    stem[a - c0:b - c0] += data[a - start:b - start]
+                if stems:
+                    mix += stem
+                    stem_chunks.append(np.clip(stem, info.min, info.max).astype(dtype))
+            yield np.clip(mix, info.min, info.max).astype(dtype), stem_chunks
+
+    def export(self, path, stem_paths=None):
+        """
+        stream the remix (and optionally each stem) into wav files
+
+        Args:
+            path : destination of the remix
+            stem_paths : optional list of destinations, one per stem
+        """
+        if len(self.repeaters) == 0:
+            return
+        first = self.repeaters[0]
+        first.decoded()
+        paths = [path] + (list(stem_paths) if stem_paths is not None else [])
+        outs = [wave.open(p, 'wb') for p in paths]
+        try:
+            for out in outs:
+                out.setnchannels(first.channels)
+                out.setsampwidth(first.sample_width)
+                out.setframerate(first.frame_rate)
+            for mix, stem_chunks in self.chunks(stems=stem_paths is not None):
+                outs[0].writeframes(mix.tobytes())
+                if stem_chunks is not None:
+                    for out, stem in zip(outs[1:], stem_chunks):
+                        out.writeframes(stem.tobytes())
+        finally:
+            for out in outs:
+                out.close()
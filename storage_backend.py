@@ -0,0 +1,530 @@
+import os
+import json
+import mmap
+import uuid
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+import gridfs
+from bson import ObjectId
+from gridfs.errors import FileExists
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+"""
+storage a Database keeps its files and their metadata in
+two interchangeable implementations:
+    - GridFSStorage : a MongoDB server, one database per name, files in GridFS
+    - LocalStorage : a directory per name holding one plain (memory-mappable)
+                     file per payload and a SQLite index of their metadata,
+                     so everything runs on one machine with no server
+a Storage opens named stores (StorageBackend), both describe a file by a
+document of the same shape:
+    {"_id": file ID, "filename": name, "length": payload size, "metadata": dict or None}
+"""
+
+class DuplicateFileError(Exception):
+    """a file with a kind was stored under a name a file of a kind already has"""
+
+
+class StorageBackend(ABC):
+    """
+    files and metadata of one named store
+
+    queries only ever match a file's name or metadata.kind and sort by
+    filename or metadata.rank, which is all a Database needs
+
+    Attributes:
+        name : name of the store
+    """
+    @abstractmethod
+    def put(self, data, name, metadata=None):
+        """
+        Store a payload
+
+        Args:
+            data:   bytes or file object of the payload
+            name:   filename
+            metadata:   metadata document for the file
+        Returns:
+            file ID
+        Raises:
+            DuplicateFileError: if ensure_indexes made names unique and name is taken
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def buffer(self, file_id):
+        """
+        Returns:
+            bytes-like object holding the whole payload of file_id
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, file_id):
+        """Delete a file and its payload"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_one(self, name=None, file_id=None):
+        """
+        Returns:
+            the first stored document with filename name (or ID file_id), or None
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def find(self, name=None, kind=None, sort="filename"):
+        """
+        documents of every file matching name and kind, without their bar_probs
+
+        Args:
+            name:   filename to match, None matches all
+            kind:   metadata.kind to match, None matches all
+            sort:   "filename" or "rank"
+        Returns:
+            list of documents
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def catalogue(self):
+        """
+        documents of every file, in storage order, with metadata.bar_probs
+        replaced by its length in n_bar_probs
+
+        Returns:
+            list of documents
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_metadata(self, name, fields):
+        """
+        Set metadata fields of the first file called name
+
+        Returns:
+            updated document or None if there is no such file
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def inc_metadata(self, name, field, amount):
+        """
+        Atomically add amount to a numeric metadata field of the first file called name
+
+        Returns:
+            updated document or None if there is no such file
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def ensure_indexes(self, unique_filenames=False):
+        """
+        Create the indexes lookups rely on if they do not exist yet
+            - filename
+            - unique filename for files with a kind, if unique_filenames
+            - metadata.kind with metadata.rank, for listing files of a kind in rank order
+        """
+        raise NotImplementedError
+
+    def record_legacy_kinds(self):
+        """Record metadata.kind for files stored before kinds were, if the store can have any"""
+        pass
+
+
+class Storage(ABC):
+    """
+    where named stores live, hands out one StorageBackend per name
+    """
+    @abstractmethod
+    def open(self, name):
+        """
+        Returns:
+            StorageBackend for the store called name, created if needed
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def names(self):
+        """
+        Returns:
+            names of every store
+        """
+        raise NotImplementedError
+
+
+class GridFSBackend(StorageBackend):
+    """
+    store kept in a MongoDB database, payloads in its GridFS bucket
+
+    Attributes:
+        db  (Database): The PyMongo database instance
+        bucket  (GridFS):   The GridFS bucket for file storage
+    """
+    # how files stored before kinds were recorded are recognised
+    LEGACY_KINDS = [
+        ("full_track", {"filename": "full_track"}),
+        ("repeated", {"filename": {"$regex": "_repeated\\.wav$"}}),
+        ("separated_loop", {"filename": {"$regex": "^separated_loop"}}),
+        ("sonic_sample", {"metadata.rank": {"$nin": [0, None]}}),
+        ("extracted_sample", {"metadata.rank": 0, "metadata.bar_probs.2": {"$exists": True}}),
+    ]
+
+    def __init__(self, db):
+        self.name = db.name
+        self.db = db
+        self.bucket = gridfs.GridFS(db)
+        self.files = self.bucket._files
+        self.chunks = self.bucket._chunks
+
+    def put(self, data, name, metadata=None):
+        file_id = ObjectId()
+        try:
+            return self.bucket.put(data, _id=file_id, filename=name, metadata=metadata)
+        except (FileExists, DuplicateKeyError) as e:
+            # GridFS reports the unique filename index refusing the files
+            # document as FileExists, after the chunks were already written
+            self.chunks.delete_many({"files_id": file_id})
+            raise DuplicateFileError(name) from e
+
+    def buffer(self, file_id):
+        # copy the chunks once into a preallocated buffer
+        grid_out = self.bucket.get(file_id)
+        buf = bytearray(grid_out.length)
+        view = memoryview(buf)
+        pos = 0
+        chunk = grid_out.readchunk()
+        while chunk:
+            view[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+            chunk = grid_out.readchunk()
+        return buf
+
+    def delete(self, file_id):
+        self.bucket.delete(file_id)
+
+    def find_one(self, name=None, file_id=None):
+        query = {'_id': file_id} if file_id is not None else {'filename': name}
+        return self.files.find_one(query)
+
+    def find(self, name=None, kind=None, sort="filename"):
+        query = {}
+        if name is not None:
+            query['filename'] = name
+        if kind is not None:
+            query['metadata.kind'] = kind
+        sort = "metadata.rank" if sort == "rank" else "filename"
+        return list(self.files.find(query, {'metadata.bar_probs': 0}).sort(sort, 1))
+
+    def catalogue(self):
+        n_bar_probs = {"$cond": [{"$isArray": "$metadata.bar_probs"}, {"$size": "$metadata.bar_probs"}, None]}
+        docs = []
+        for doc in self.files.aggregate([{"$addFields": {"n_bar_probs": n_bar_probs}},
+                                         {"$project": {"metadata.bar_probs": 0}}]):
+            if doc.get('metadata') is None:
+                doc['metadata'] = None
+            docs.append(doc)
+        return docs
+
+    def set_metadata(self, name, fields):
+        update = {f"metadata.{k}": v for k, v in fields.items()}
+        return self.files.find_one_and_update({'filename': name}, {"$set": update},
+                                              return_document=ReturnDocument.AFTER)
+
+    def inc_metadata(self, name, field, amount):
+        return self.files.find_one_and_update({'filename': name}, {"$inc": {f"metadata.{field}": amount}},
+                                              return_document=ReturnDocument.AFTER)
+
+    def ensure_indexes(self, unique_filenames=False):
+        # GridFS itself indexes filename with uploadDate on first write
+        if unique_filenames:
+            self.files.create_index("filename", unique=True, name="filename_unique",
+                                    partialFilterExpression={"metadata.kind": {"$exists": True}})
+        self.files.create_index([("metadata.kind", 1), ("metadata.rank", 1)])
+
+    def record_legacy_kinds(self):
+        for kind, query in self.LEGACY_KINDS:
+            self.files.update_many(dict(query, metadata=None), {"$set": {"metadata": {"kind": kind}}})
+            self.files.update_many(dict(query, **{"metadata.kind": {"$exists": False}}), {"$set": {"metadata.kind": kind}})
+
+
+# options every MongoClient from get_client is made with unless overridden,
+# change before the first get_client call (or pass options) to configure them
+CLIENT_OPTIONS = {
+    "maxPoolSize": 20,
+    "serverSelectionTimeoutMS": 5000,
+    "connectTimeoutMS": 5000,
+    "socketTimeoutMS": 60000,
+}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(host="localhost", port=27017, **options):
+    """
+    process-wide MongoClient for a server, created on first use
+
+    a MongoClient pools its connections and is safe to share between threads,
+    so every Database and worker thread talking to the same server with the
+    same options gets the same client instead of opening its own
+
+    Args:
+        host, port: server address
+        options:    MongoClient keyword options, on top of CLIENT_OPTIONS
+    Returns:
+        MongoClient
+    """
+    with _clients_lock:
+        return _client_locked(host, port, **options)
+
+def _client_locked(host="localhost", port=27017, **options):
+    """get_client for callers already holding _clients_lock"""
+    options = dict(CLIENT_OPTIONS, **options)
+    key = (host, port, tuple(sorted(options.items())))
+    client = _clients.get(key)
+    if client is None:
+        client = MongoClient(host, port, **options)
+        _clients[key] = client
+    return client
+
+def close_clients():
+    """close every client get_client has handed out"""
+    global _default_storage
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        # a default GridFSStorage would otherwise keep a closed client
+        if isinstance(_default_storage, GridFSStorage):
+            _default_storage = None
+
+
+class GridFSStorage(Storage):
+    """
+    stores kept as databases on a MongoDB server
+
+    Attributes:
+        client  (MongoClient): connection pool to the server, shared through get_client by default
+    """
+    # databases MongoDB keeps for itself
+    SYSTEM_DATABASES = ["admin", "config", "local"]
+
+    def __init__(self, client=None):
+        self.client = client if client is not None else get_client()
+
+    def open(self, name):
+        return GridFSBackend(self.client[name])
+
+    def names(self):
+        return [n for n in self.client.list_database_names() if n not in self.SYSTEM_DATABASES]
+
+
+class LocalBackend(StorageBackend):
+    """
+    store kept in a local directory: each payload is a plain file named by its
+    file ID, and index.sqlite holds one row of metadata per file
+
+    kind and rank are copied out of the metadata into their own indexed columns;
+    SQLite connections are per thread so worker threads can share a backend
+
+    payloads from MMAP_THRESHOLD bytes up are memory mapped rather than read,
+    anything smaller is copied so no mapping keeps its file open
+
+    Attributes:
+        path : directory of the store
+    """
+    MMAP_THRESHOLD = 16 * 1024 * 1024
+
+    def __init__(self, path):
+        self.name = os.path.basename(path)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._local = threading.local()
+        # payloads of deleted files that were still mapped
+        self._pending_removals = set()
+
+    @property
+    def _conn(self):
+        """this thread's connection to the metadata index"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.path, "index.sqlite"), timeout=30, isolation_level=None)
+            conn.execute("CREATE TABLE IF NOT EXISTS files (id TEXT PRIMARY KEY, filename TEXT NOT NULL, "
+                         "kind TEXT, rank REAL, length INTEGER, upload_date REAL, metadata TEXT)")
+            self._local.conn = conn
+        return conn
+
+    def _payload_path(self, file_id):
+        return os.path.join(self.path, f"{file_id}.bin")
+
+    @staticmethod
+    def _doc(row):
+        """document from an (id, filename, length, upload_date, metadata) row"""
+        file_id, filename, length, upload_date, metadata = row
+        return {"_id": file_id, "filename": filename, "length": length, "uploadDate": upload_date,
+                "metadata": json.loads(metadata) if metadata is not None else None}
+
+    def put(self, data, name, metadata=None):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = data.read()
+        file_id = uuid.uuid4().hex
+        path = self._payload_path(file_id)
+        # write then rename, so a payload is never seen half written
+        with open(path + ".part", "wb") as out:
+            out.write(data)
+        os.replace(path + ".part", path)
+        metadata_json = json.dumps(metadata) if metadata is not None else None
+        kind = metadata.get("kind") if metadata is not None else None
+        rank = metadata.get("rank") if metadata is not None else None
+        try:
+            self._conn.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (file_id, name, kind, rank, len(data), time.time(), metadata_json))
+        except sqlite3.IntegrityError as e:
+            os.remove(path)
+            raise DuplicateFileError(name) from e
+        return file_id
+
+    def buffer(self, file_id):
+        with open(self._payload_path(file_id), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.MMAP_THRESHOLD:
+                return f.read()
+            # map large payloads instead of reading them
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def delete(self, file_id):
+        self._conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+        self._remove_payload(self._payload_path(file_id))
+        self._remove_pending()
+
+    def _remove_payload(self, path):
+        """
+        remove a payload file; a payload still mapped by a buffer can not be
+        removed on Windows, so it is kept for a later delete to retry
+        """
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return True
+        except OSError:
+            self._pending_removals.add(path)
+            return False
+
+    def _remove_pending(self):
+        """retry removing payloads that were still mapped when deleted"""
+        for path in list(self._pending_removals):
+            if self._remove_payload(path):
+                self._pending_removals.discard(path)
+
+    def find_one(self, name=None, file_id=None):
+        if file_id is not None:
+            where, arg = "id = ?", file_id
+        else:
+            where, arg = "filename = ?", name
+        row = self._conn.execute(f"SELECT id, filename, length, upload_date, metadata FROM files "
+                                 f"WHERE {where} ORDER BY rowid LIMIT 1", (arg,)).fetchone()
+        return self._doc(row) if row is not None else None
+
+    def find(self, name=None, kind=None, sort="filename"):
+        where, args = [], []
+        if name is not None:
+            where.append("filename = ?")
+            args.append(name)
+        if kind is not None:
+            where.append("kind = ?")
+            args.append(kind)
+        query = "SELECT id, filename, length, upload_date, json_remove(metadata, '$.bar_probs') FROM files"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY rank, rowid" if sort == "rank" else " ORDER BY filename, rowid"
+        return [self._doc(row) for row in self._conn.execute(query, args)]
+
+    def catalogue(self):
+        docs = []
+        for row in self._conn.execute("SELECT id, filename, length, upload_date, json_remove(metadata, '$.bar_probs'), "
+                                      "json_array_length(metadata, '$.bar_probs') FROM files ORDER BY rowid"):
+            doc = self._doc(row[:5])
+            doc['n_bar_probs'] = row[5]
+            docs.append(doc)
+        return docs
+
+    def _update_metadata(self, name, update):
+        """apply update(metadata) to the first file called name inside one write transaction"""
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT id, filename, length, upload_date, metadata FROM files "
+                               "WHERE filename = ? ORDER BY rowid LIMIT 1", (name,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            doc = self._doc(row)
+            metadata = doc['metadata'] if doc['metadata'] is not None else {}
+            update(metadata)
+            conn.execute("UPDATE files SET metadata = ?, kind = ?, rank = ? WHERE id = ?",
+                         (json.dumps(metadata), metadata.get("kind"), metadata.get("rank"), doc['_id']))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        doc['metadata'] = metadata
+        return doc
+
+    def set_metadata(self, name, fields):
+        return self._update_metadata(name, lambda metadata: metadata.update(fields))
+
+    def inc_metadata(self, name, field, amount):
+        def inc(metadata):
+            metadata[field] = metadata.get(field, 0) + amount
+        return self._update_metadata(name, inc)
+
+    def ensure_indexes(self, unique_filenames=False):
+        self._conn.execute("CREATE INDEX IF NOT EXISTS files_filename ON files (filename)")
+        if unique_filenames:
+            self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS files_filename_unique ON files (filename) "
+                               "WHERE kind IS NOT NULL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS files_kind_rank ON files (kind, rank)")
+
+
+class LocalStorage(Storage):
+    """
+    stores kept as subdirectories of a local directory
+
+    Attributes:
+        root : directory holding one subdirectory per store
+    """
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def open(self, name):
+        return LocalBackend(os.path.join(self.root, name))
+
+    def names(self):
+        return sorted(n for n in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, n)))
+
+
+_default_storage = None
+
+def default_storage():
+    """
+    Storage a Database uses when not given one, MongoDB on localhost unless
+    set_default_storage chose another
+    """
+    global _default_storage
+    with _clients_lock:
+        if _default_storage is None:
+            _default_storage = GridFSStorage(_client_locked())
+        return _default_storage
+
+def set_default_storage(storage):
+    """
+    Make every Database created afterwards use storage by default,
+    e.g. set_default_storage(LocalStorage("audio_db")) to run without a server
+    """
+    global _default_storage
+    _default_storage = storage
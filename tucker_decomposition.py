@@ -0,0 +1,116 @@
+import time
+import numpy as np
+import tensorly as tl
+from tensorly.tenalg import multi_mode_dot
+
+"""
+Non-negative Tucker decomposition driver for loop extraction
+same multiplicative updates as tensorly's non_negative_tucker, but
+    - can warm start from an earlier decomposition, resized to the new ranks
+    - stops on the relative change of the reconstruction error
+    - measures the error from core sized products instead of rebuilding the tensor
+    - records the time of every iteration
+"""
+
+# floor of numerators and denominators in the multiplicative updates
+EPSILON = 10e-12
+
+def svd_init(tensor, rank):
+    """
+    non-negative SVD initialisation: absolute leading singular vectors
+    of each unfolding, and the tensor projected onto them as core
+
+    Returns:
+        core, factors
+    """
+    factors = []
+    for mode, r in enumerate(rank):
+        u, _, _ = np.linalg.svd(tl.unfold(tensor, mode), full_matrices=False)
+        factors.append(np.abs(u[:, :r]))
+    core = np.abs(multi_mode_dot(tensor, factors, transpose=True))
+    return core, factors
+
+def resize_tucker(core, factors, rank, random_state=None):
+    """
+    truncate or expand a decomposition to new ranks
+    truncating keeps the components carrying the most energy, expanding adds
+    positive random components as the multiplicative updates cannot move zeros
+
+    Args:
+        core, factors : decomposition to resize
+        rank : new rank of each mode
+        random_state : seed or RandomState for new components
+    Returns:
+        core, factors
+    """
+    rng = tl.check_random_state(random_state)
+    core = np.array(core, dtype=float)
+    factors = [np.array(f, dtype=float) for f in factors]
+    for mode, r in enumerate(rank):
+        f = factors[mode]
+        k = f.shape[1]
+        if r < k:
+            core_energy = np.sum(tl.unfold(core, mode)**2, axis=1)
+            weight = np.linalg.norm(f, axis=0) * np.sqrt(core_energy)
+            keep = np.sort(np.argsort(weight)[::-1][:r])
+            factors[mode] = f[:, keep]
+            core = np.take(core, keep, axis=mode)
+        elif r > k:
+            factors[mode] = np.concatenate([f, f.mean()*rng.random_sample((f.shape[0], r - k))], axis=1)
+            pad = [(0, 0)]*core.ndim
+            pad[mode] = (0, r - k)
+            core = np.pad(core, pad, constant_values=core.mean())
+    return core, factors
+
+def non_negative_tucker(tensor, rank, init=None, n_iter_max=500, tol=1e-5, random_state=None, verbose=False):
+    """
+    non-negative Tucker decomposition by multiplicative updates
+
+    Args:
+        tensor : non-negative ndarray
+        rank : rank of each mode
+        init : optional (core, factors) to start from, resized to rank if needed,
+               defaults to a non-negative SVD initialisation
+        n_iter_max : iteration limit
+        tol : stop once the reconstruction error improves by less than this fraction
+        random_state : seed or RandomState for components added to init
+        verbose : print error and time of each iteration
+    Returns:
+        core, factors, rec_errors, iter_times
+    """
+    tensor = np.asarray(tensor, dtype=float)
+    rank = list(rank)
+    if init is None:
+        core, factors = svd_init(tensor, rank)
+    else:
+        core, factors = resize_tucker(init[0], init[1], rank, random_state)
+
+    norm_sq = tl.norm(tensor, 2)**2
+    rec_errors = []
+    iter_times = []
+    for iteration in range(n_iter_max):
+        start = time.perf_counter()
+        for mode in range(tensor.ndim):
+            B = tl.tucker_to_tensor((core, factors), skip_factor=mode)
+            B = tl.transpose(tl.unfold(B, mode))
+            numerator = tl.clip(tl.dot(tl.unfold(tensor, mode), B), a_min=EPSILON)
+            denominator = tl.clip(tl.dot(factors[mode], tl.dot(tl.transpose(B), B)), a_min=EPSILON)
+            factors[mode] *= numerator / denominator
+
+        projected = tl.tucker_to_tensor((tensor, factors), transpose_factors=True)
+        grams = [tl.dot(tl.transpose(f), f) for f in factors]
+        denominator = tl.clip(multi_mode_dot(core, grams), a_min=EPSILON)
+        core *= tl.clip(projected, a_min=EPSILON) / denominator
+
+        # ||X - [G; U]||^2 = ||X||^2 - 2<G, X x U^T> + <G, G x U^T U>
+        fit = norm_sq - 2*np.sum(core*projected) + np.sum(core*multi_mode_dot(core, grams))
+        rec_errors.append(np.sqrt(max(fit, 0)/norm_sq))
+        iter_times.append(time.perf_counter() - start)
+        if verbose:
+            print(f"iteration {iteration}: reconstruction error={rec_errors[-1]:.6f}, {iter_times[-1]*1000:.1f} ms")
+
+        if iteration > 1 and rec_errors[-2] - rec_errors[-1] < tol*rec_errors[-2]:
+            if verbose:
+                print(f"converged in {iteration + 1} iterations, {sum(iter_times):.2f} s")
+            break
+    return core, factors, np.array(rec_errors), np.array(iter_times)
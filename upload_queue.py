@@ -0,0 +1,66 @@
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Background uploads for loop extraction results
+database writes are handed to a small thread pool so they run
+concurrently with each other and with the extraction still in progress
+"""
+
+class UploadQueue:
+    """
+    Runs database uploads on background threads
+
+    use as a context manager, leaving it waits for every upload:
+        with UploadQueue() as uploads:
+            future = uploads.submit(database.add_source_separated_loop, name, buf)
+            ...
+            file_id = future.result()   # when a later step needs it
+
+    Attributes:
+        max_workers : number of uploads running at once
+    """
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload")
+        self._futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) to run on an upload thread
+
+        Returns:
+            Future holding fn's result
+        """
+        future = self._executor.submit(fn, *args, **kwargs)
+        self._futures.append(future)
+        return future
+
+    def wait(self):
+        """
+        Block until every queued upload has finished
+
+        Raises:
+            the first exception an upload raised
+        """
+        futures, self._futures = self._futures, []
+        error = None
+        for future in futures:
+            e = future.exception()
+            if e is not None and error is None:
+                error = e
+        if error is not None:
+            raise error
+
+    def close(self):
+        """wait for queued uploads then stop the upload threads"""
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False